@@ -7,21 +7,53 @@
 #   anyone other than me.
 
 """
-Usage: archnews [options]
+Usage: archnews [options] [<feed>...]
 
 Options:
   --pretty
   --terse
   -v, --verbose                  Enable verbose output
   -l <number>, --limit <number>  Limit to <number> recent posts
+  --max-age <seconds>            Show cached news younger than this without
+                                 asking the server [default: 300]
+  --offline                      Only show cached news, never fetch
+  --no-cache                     Do not read or write the shared http cache
+  -f <file>, --feeds <file>      Show the feeds listed in <file>, one url per line
+  -t <seconds>, --timeout <seconds>  Give up on a feed after this long [default: 10]
+  -n, --new                      Only show news not shown by an earlier --new,
+                                 exit with status 1 if there was any
+  -w, --watch                    Keep running, showing news as it is published
+  -i <seconds>, --interval <seconds>  How often --watch checks the feeds [default: 600]
+  --seen-index <path>            Where to remember the news already shown
+                                 [default: ~/.cache/archnews/seen.json]
+  --profile                      Time fetching, parsing and rendering, writing
+                                 a json report to stderr on exit
+  --profile-file <path>          Write the --profile report to <path> instead
+  --cprofile <path>              Also write cProfile stats of the main thread to <path>
 
 Displays a list of the recent arch linux news entries (limited using -l)
-in a nicely formatted table.
+in a nicely formatted table. When other (rss or atom) feeds are given,
+their items are fetched concurrently and shown merged together, most
+recent first.
+
+Exits with status 2 if none of the feeds could be fetched.
 """
-from bs4 import BeautifulSoup
-import requests
+from datetime import datetime, timezone
 from docopt import docopt
+from io import BytesIO
+from itertools import chain, islice
+from urllib.parse import urlparse
+import heapq
+import json
+import os
 import sys
+import time
+import httpcache
+from profiling import profiler
+
+# Slow to import modules (lxml, requests, email.utils,
+# concurrent.futures) are imported where they are used,
+# so that --help and bad arguments are quick.
 
 ### FROM confs/common.py
 def is_interactive():
@@ -32,6 +64,7 @@ class ArgFlags:
     pretty_or_terse_flag_present = False
     verbose = False
     interactive = False
+    profile = False
 
     @staticmethod
     def from_args(args):
@@ -45,6 +78,8 @@ class ArgFlags:
                 ArgFlags.pretty_or_terse_flag_present = True
             elif arg == '--verbose':
                 ArgFlags.verbose = True
+            elif arg in ('--profile', '--profile-file', '--cprofile'):
+                ArgFlags.profile = True
 
         if not ArgFlags.pretty_or_terse_flag_present:
             # use --pretty implicitly when interactive
@@ -82,72 +117,258 @@ def pprint(fargs, *args, word_wrap=True, warning=False, bold=False, success=Fals
 def stringify(row):
     return [str(c) for c in row]
 
-def align_columns(rows, column_options=None, spacing=1, header=None):
+def align_columns(rows, column_options=None, spacing=1, header=None, widths=None, lookahead=1000):
     """
-    Aligns columns in a row of items.
+    Aligns columns in a row of items, yielding one line per row (header first).
     column_options is a list containing descibing how each column
     should be aligned
     Example: ['left', 'center', 'right'] will align the first column to the
     left, the second to the center, and the third to the right.
+    Column widths are the given widths, or else the widest cell of each
+    column among the header and the first lookahead rows. Wider rows after
+    that are not cut, only out of line, so that lines can be produced
+    while rows is still being iterated.
     """
-
-    srows = []
+    rows = iter(rows)
+    first_rows = []
     if header:
-        srows.append(stringify(header))
-    srows = srows + [stringify(row) for row in rows]
-
-    column_details = {}
-    for r in srows:
-        for i, c in enumerate(r):
-            if i not in column_details:
-                column_details[i] = {'width': 0}
-            column_details[i]['width'] = max(column_details[i]['width'], len(c))
+        first_rows.append(stringify(header))
+    if widths is None:
+        first_rows += [stringify(row) for row in islice(rows, lookahead)]
+        widths = []
+        for r in first_rows:
+            for i, c in enumerate(r):
+                if i == len(widths):
+                    widths.append(0)
+                widths[i] = max(widths[i], len(c))
 
     spacing_str = ' ' * spacing
 
-    def align_row(row):
-        nonlocal column_details, column_options
+    def row_format(n_columns):
         out_columns = []
-        for i, c in enumerate(row):
+        for i in range(n_columns):
             align_chr = '<' # left-align by default
             if column_options:
                 if column_options[i] == 'right':
                         align_chr = '>'
                 elif column_options[i] == 'center':
                         align_chr = '^'
-            out_columns.append('{0:{1}{2}}'.format(c, align_chr, column_details[i]['width']))
+            width = widths[i] if i < len(widths) else 0
+            out_columns.append('{%d:%s%d}' % (i, align_chr, width))
         return spacing_str.join(out_columns)
 
-    out = []
-    for r in srows:
-        out.append(align_row(r))
-    return out
+    # One format string per number of columns, usually just one per table
+    formats = {}
+    for r in chain(first_rows, (stringify(row) for row in rows)):
+        if len(r) not in formats:
+            formats[len(r)] = row_format(len(r))
+        yield formats[len(r)].format(*r)
 
 
-def print_rows(rows, column_options=None, spacing=1, header=None, enabled_rows=set(), **kwargs):
+def print_rows(rows, column_options=None, spacing=1, header=None, enabled_rows=set(), widths=None, **kwargs):
+    """
+    Prints rows (any iterable) while they are produced, see align_columns
+    for widths.
+    """
     # TODO **kwargs
     # Only print header if pretty
-    if len(rows) < 1:
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
         return False
-
+    rows = chain([first_row], rows)
     if ArgFlags.pretty:
-        aligned = align_columns(rows=rows, column_options=column_options, spacing=spacing, header=header)
+        aligned = align_columns(rows=rows, column_options=column_options, spacing=spacing, header=header, widths=widths)
         #print(aligned)
         if header:
             #### MODIFIED : header=True => arch=True, for the maximum arch like experience
-            pprint(aligned[0], arch=True, bold=True, **kwargs)
-            aligned.pop(0)
+            pprint(next(aligned), arch=True, bold=True, **kwargs)
         for i, row in enumerate(aligned):
             pprint(row, enabled=(i in enabled_rows), **kwargs)
     else:
         for row in rows:
-            print('{}'.format(' '.join(stringify(row))))
+            print(' '.join(stringify(row)), **kwargs)
 
     return True
 ### END OF COPY
 
 
 ARCH_NEWS = 'https://www.archlinux.org/feeds/news'
+ATOM = '{http://www.w3.org/2005/Atom}'
+# The key of the parsed items in the http cache, changed with their fields
+# so that items cached by older versions are parsed again
+ITEMS_PARSE_KEY = 'parse_items/id'
+
+def atom_date(text):
+    """The RFC 3339 date of an atom entry as an RFC 2822 date, like those of rss"""
+    from email.utils import format_datetime
+    try:
+        return format_datetime(datetime.fromisoformat(text.strip().replace('Z', '+00:00')))
+    except ValueError:
+        return text
+
+def atom_link(entry):
+    for link in entry.iterfind(ATOM + 'link'):
+        if link.get('rel', 'alternate') == 'alternate':
+            return link.get('href', '')
+    return ''
+
+def item_id(guid, link, published, title):
+    """What tells an item apart: its guid (or atom id), else its link"""
+    return guid or link or published + ' ' + title
+
+def iter_items(source):
+    """
+    Incrementally parses the rss or atom feed read from the file object
+    source, yielding [published, title, url, id] as soon as each item (or
+    entry) has been read, see item_id.
+    """
+    from lxml import etree
+    context = etree.iterparse(source, events=('end',), tag=('item', ATOM + 'entry'))
+    found = False
+    for _, item in context:
+        found = True
+        if item.tag == 'item':
+            fields = [item.findtext('pubDate', ''), item.findtext('title', ''), item.findtext('link', '')]
+            guid = item.findtext('guid')
+        else:
+            date = item.findtext(ATOM + 'published') or item.findtext(ATOM + 'updated', '')
+            fields = [atom_date(date), item.findtext(ATOM + 'title', ''), atom_link(item)]
+            guid = item.findtext(ATOM + 'id')
+        yield fields + [item_id((guid or '').strip(), fields[2], fields[0], fields[1])]
+        # Only the current item is ever kept in memory
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+    if not found and context.root is not None and context.root.tag not in ('rss', ATOM + 'feed'):
+        print('unsupported feed format <{}>, only rss and atom are supported'.format(context.root.tag),
+              file=sys.stderr)
+
+def parse_items(xml):
+    return list(iter_items(BytesIO(xml.encode())))
+
+def fetch_items(cache, url, max_age, limit=None, timeout=None):
+    """
+    Returns at most limit items of the feed at url. Unless the cache can
+    answer, only as much of the feed as is needed for limit items is
+    parsed (and without a cache, read).
+    """
+    if limit is None:
+        # The whole feed is needed anyway, so read and cache all of it
+        return cache.fetch(url, ttl=max_age, parse=parse_items, parse_key=ITEMS_PARSE_KEY, timeout=timeout).parsed
+
+    r = cache.fetch(url, ttl=max_age, parse=parse_items, parse_key=ITEMS_PARSE_KEY, stream=True,
+                    timeout=timeout)
+    if r.from_cache:
+        return r.parsed[:limit]
+    with r, profiler.phase('parse', url=url, cached=False, streamed=True) as phase:
+        # Stops parsing once limit items are parsed. When the feed is
+        # cached, the rest of it is still read (on leaving the with
+        # block) so that later runs can use the cached feed
+        items = list(islice(iter_items(r.raw), limit))
+        phase['bytes'] = r.raw.tell()
+    return items
+
+def feed_names(urls):
+    """Short names of urls for the Feed column: the host, and the path where hosts are shared"""
+    hosts = [urlparse(url).netloc for url in urls]
+    return {url: host if hosts.count(host) == 1 else host + urlparse(url).path.rstrip('/')
+            for url, host in zip(urls, hosts)}
+
+def published(item):
+    """The publishing date of item, as a timezone aware datetime"""
+    from email.utils import parsedate_to_datetime
+    try:
+        date = parsedate_to_datetime(item[0])
+    except (TypeError, ValueError):
+        return datetime.min.replace(tzinfo=timezone.utc)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+def merge_feeds(feeds, limit=None):
+    """
+    Merges lists of items, each most recent first, into a single stream of
+    the most recent items, using a k-way heap merge which only looks at as
+    many items as it yields.
+    """
+    keyed = []
+    for items in feeds:
+        dates = [published(item) for item in items]
+        pairs = list(zip(dates, items))
+        if any(a < b for a, b in zip(dates, dates[1:])):
+            # Not most recent first, as feeds usually are
+            pairs.sort(key=lambda pair: pair[0], reverse=True)
+        keyed.append(pairs)
+    merged = heapq.merge(*keyed, key=lambda pair: pair[0], reverse=True)
+    return [item for _, item in islice(merged, limit)]
+
+def read_feeds_file(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+def fetch_feeds(cache, urls, max_age, limit=None, timeout=None):
+    """Fetches the feeds concurrently, returns {url: items} of the feeds that could be fetched"""
+    from concurrent.futures import ThreadPoolExecutor
+    from lxml import etree
+    import requests
+
+    def fetch(url):
+        try:
+            return fetch_items(cache, url, max_age, limit, timeout)
+        except (requests.RequestException, etree.XMLSyntaxError) as e:
+            print('Failed to fetch {}: {}'.format(url, e), file=sys.stderr)
+        except httpcache.OfflineCacheMiss:
+            print('No cached news available for', url, file=sys.stderr)
+        return None
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        results = executor.map(fetch, urls)
+        return {url: items for url, items in zip(urls, results) if items is not None}
+
+class SeenIndex:
+    """
+    The news already shown, a dict of item id -> when it was last seen in
+    a feed, ordered from least to most recently seen. Entries that have
+    not been in any feed for max_age seconds are evicted, as are the
+    oldest entries beyond max_entries.
+    """
+    def __init__(self, path, max_entries=10000, max_age=365 * 24 * 60 * 60):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        try:
+            with open(path) as f:
+                self.seen = json.load(f)
+        except FileNotFoundError:
+            self.seen = {}
+
+    def __contains__(self, key):
+        return key in self.seen
+
+    def add(self, keys):
+        now = int(time.time())
+        for key in keys:
+            # Move to the end, keeping the dict ordered by when last seen
+            self.seen.pop(key, None)
+            self.seen[key] = now
+
+    def evict(self):
+        oldest = time.time() - self.max_age
+        n_evict = max(0, len(self.seen) - self.max_entries)
+        for key, last_seen in list(self.seen.items()):
+            if n_evict <= 0 and last_seen >= oldest:
+                break
+            del self.seen[key]
+            n_evict -= 1
+
+    def save(self):
+        self.evict()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.seen, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
 
 def main(argv):
     args = docopt(__doc__, argv)
@@ -155,17 +376,64 @@ def main(argv):
     ArgFlags.from_args(args)
     if ArgFlags.verbose:
         print(args)
+    if ArgFlags.profile:
+        profiler.enable(args['--profile-file'], args['--cprofile'])
 
-    r = requests.get(ARCH_NEWS)
-    xml = r.text
+    cache = httpcache.HTTPCache(None if args['--no-cache'] else httpcache.DEFAULT_CACHE_DIR,
+                                offline=args['--offline'])
+    urls = args['<feed>']
+    if args['--feeds']:
+        urls += read_feeds_file(args['--feeds'])
+    urls = urls or [ARCH_NEWS]
 
-    soup = BeautifulSoup(xml, 'xml')
-    items = soup.findAll('item')
+    limit = int(args['--limit']) if args['--limit'] else None
+    max_age = float(args['--max-age'])
+    seen = None
+    if args['--new'] or args['--watch']:
+        seen = SeenIndex(os.path.expanduser(args['--seen-index']))
 
-    pprint(":: News", bold=True)
     header = ['Published', 'Title', 'URL']
-    rows = [[i.pubDate.text, i.title.text, i.link.text] for i in items[:int(args['--limit'] or -1)]]
-    print_rows(rows, spacing=3, header=header)
+    if len(urls) > 1:
+        # Show where each item came from
+        header.append('Feed')
+
+    while True:
+        if args['--watch']:
+            # Read and cache whole feeds, so that they are
+            # revalidated with a cheap conditional request
+            feeds = fetch_feeds(cache, urls, 0, None, float(args['--timeout']))
+        else:
+            feeds = fetch_feeds(cache, urls, max_age, limit, float(args['--timeout']))
+
+        if len(urls) > 1:
+            names = feed_names(urls)
+            feeds = {url: [item + [names[url]] for item in items] for url, items in feeds.items()}
+        rows = merge_feeds(feeds.values(), limit)
+
+        if seen is not None:
+            # Older versions remembered the urls of the items instead
+            new_rows = [row for row in rows if row[3] not in seen and not (row[2] and row[2] in seen)]
+            seen.add(row[3] for row in rows)
+            seen.save()
+        else:
+            new_rows = rows
+        # Without the id
+        new_rows = [row[:3] + row[4:] for row in new_rows]
+
+        if new_rows or seen is None:
+            pprint(":: News", bold=True)
+            with profiler.phase('render', rows=len(new_rows)):
+                print_rows(new_rows, spacing=3, header=header)
+
+        if not args['--watch']:
+            break
+        sys.stdout.flush()
+        time.sleep(float(args['--interval']))
+
+    if not feeds:
+        sys.exit(2)
+    if args['--new'] and new_rows:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,1157 @@
+#!/usr/bin/env python3
+# Author: Jørgen Bele Reinfjell
+# Date: 17.10.2026 [dd.mm.yyyy]
+# Description:
+#   Benchmarks for the utilities in this repo,
+#   run from the repo directory.
+"""
+Usage:
+  bench.py ovsys-parse [options] [<fixture>...]
+  bench.py ovsys-fixtures <dir>
+  bench.py ovsys-smtp [options]
+  bench.py smtp-sink [options]
+  bench.py ovsys-replay [options]
+  bench.py ovsys-load [options]
+  bench.py archnews-parse [options]
+  bench.py table [options]
+  bench.py startup [options]
+  bench.py ontime-latency [options]
+  bench.py kv [options]
+  bench.py org-build [options]
+  bench.py org-watch [options]
+
+Options:
+  -n <number>, --number <number>  Repetitions per measurement [default: 20]
+  -m <number>, --messages <number>  Messages to send [default: 200]
+  -p <port>, --port <port>        Port to listen on [default: 8025]
+  --courses <numbers>             Comma separated course counts [default: 1,10,100,500]
+  --exercises <number>            Exercises per course [default: 30]
+  --mutate-every <seconds>        Change the status of a random exercise this often [default: 1]
+  --duration <seconds>            How long to run the daemon for [default: 15]
+  --min-interval <seconds>        Daemon poll interval of changed courses [default: 1]
+  --max-interval <seconds>        Daemon poll interval of quiet courses [default: 5]
+  --rate <requests-per-second>    Daemon request rate limit [default: 500]
+  -j <n>, --jobs <n>              Concurrent requests [default: 8]
+  --items <numbers>               Comma separated feed sizes [default: 50,1000,10000]
+  -l <number>, --limit <number>   Number of items to show [default: 10]
+  --rows <number>                 Rows in the table [default: 100000]
+  --budget <ms>                   Import time allowed per command [default: 60]
+  --sizes <numbers>               Comma separated key counts [default: 1000,10000,100000,1000000]
+  --files <number>                Org files in the tree [default: 200]
+  --emacs-startup <seconds>       Startup time of the stand-in emacs [default: 0.2]
+  --export-time <seconds>         Time the stand-in emacs takes per file [default: 0.01]
+
+Commands:
+  ovsys-parse     Compares the bs4 and lxml extraction paths of ovsys on the
+                  given saved pages (or generated small, typical and 500
+                  exercise pages), reporting parse time and peak memory.
+  ovsys-fixtures  Writes the generated ovsys pages to <dir>.
+  ovsys-smtp      Measures email throughput of ovsys with a fresh SMTP
+                  connection per message, the persistent Mailer and a
+                  digest of all messages, against a local smtp-sink.
+  smtp-sink       Runs a local SMTP server that accepts and discards mail,
+                  usable as email.host/email.port with email.starttls false.
+  ovsys-replay    Runs a local stand-in for ovsys with --courses courses
+                  (first number only) of --exercises exercises, changing
+                  one exercise every --mutate-every seconds. Use it with
+                  `ovsys --base-url` or OVSYS_BASE_URL. Any username and
+                  password is accepted.
+  ovsys-load      Runs the `ls -a` and `daemon` code paths of ovsys against
+                  a replay server for each of --courses, reporting
+                  requests/s, latency percentiles, change detection time
+                  and RSS.
+  archnews-parse  Compares fetching and parsing the whole feed with
+                  BeautifulSoup to archnews' streaming parser stopping
+                  after --limit items, on generated feeds of --items
+                  items served from a local HTTP server.
+  table           Compares rendering --rows generated rows with the
+                  streaming print_rows of ovsys to building every aligned
+                  line in a list first, as it used to, reporting time to
+                  first line, total time and peak memory.
+  startup         Measures the wall time and import time (using
+                  `python -X importtime`) of `--help` for ovsys, archnews
+                  and ontime, over the interpreter's own startup. Exits
+                  with status 1 if any of them imports for longer than
+                  --budget.
+  ontime-latency  Reports how late ontime fires, for -n deadlines 10-100 ms
+                  apart: waiting with the timerfd, waiting by looking at the
+                  clock every second (as without a timerfd), and a daemon
+                  running `date` jobs, which includes starting the command.
+  kv              Reports the latency of kv get and set on stores of each
+                  of --sizes keys: -n random operations on the KV of kv.py,
+                  the whole `kv.py get` command, and `sh kv.sh get` for
+                  stores of at most 10000 keys, as it scans the file,
+                  and the time per operation of `kv.py batch` doing
+                  100 times as many gets and sets. keys and scan list the
+                  100 keys of a random prefix, in the store of the kv.
+                  Also reports how long indexing an existing store takes.
+  org-build       Builds a generated tree of --files outdated .org files
+                  with a stand-in emacs that takes --emacs-startup to start
+                  and --export-time per file: with build_org_files.sh (one
+                  emacs per file), with build_org_files.py using one emacs
+                  and --jobs of them, again with nothing to build, after
+                  touching every file, and after editing a file included by
+                  50 of them. build_org_files.sh is only run for at most
+                  1000 files.
+  org-watch       Reports how long it takes from saving a .org file to its
+                  .md being written by `build_org_files.py --watch`, for -n
+                  edits of random files of a generated tree of --files
+                  files (with the stand-in emacs), and the CPU time it uses
+                  while nothing changes.
+"""
+
+from docopt import docopt
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socketserver
+import sys
+import threading
+import time
+import uuid
+
+### OVSYS FIXTURES
+OVSYS_CSRF_TOKEN = 'Zq3bKXfe0e3TQ7dWvmxjkFbUPEYCfx1vfaUhEuwTz4SmKc0PS3u5h3EaGk9BuQZN'
+
+OVSYS_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html lang="nb">
+<head>
+  <meta charset="utf-8">
+  <title>Øvsys</title>
+  <script>
+    $.ajaxSetup({{ data: {{ csrfmiddlewaretoken: '{csrf_token}' }} }});
+  </script>
+</head>
+<body>
+  <nav class="navbar navbar-default">
+    <a class="navbar-brand" href="/">Øvsys</a>
+    <a href="/profile/">Profil</a>
+    <a href="/logout/">Logg ut</a>
+  </nav>
+  <div class="container">
+{content}
+  </div>
+</body>
+</html>
+'''
+
+OVSYS_COURSE_LINK_TEMPLATE = '''    <a class="list-group-item" href="/student/{code}/">{code} Matematikk</a>
+'''
+
+OVSYS_EXERCISE_TEMPLATE = '''    <a class="list-group-item" href="/student/{code}/exercise/{id}">
+      <div class="row">
+        <div class="col-xs-12 col-sm-6 col-md-8"><strong>Øving {number}</strong> <small>frist 01.02.2019</small></div>
+        <div class="col-xs-12 col-sm-6 col-md-4">
+          status: {status}
+        </div>
+      </div>
+    </a>
+'''
+
+OVSYS_STATUS_STRINGS = [
+    'ikke levert, ikke rettet, ikke vurdert',
+    'levert, ikke rettet, ikke vurdert',
+    'levert, rettet, godkjent',
+    'levert, rettet, underkjent',
+]
+
+OVSYS_LOGIN_FORM = '''    <form method="post" action="/login/">
+      <input type="text" name="username">
+      <input type="password" name="password">
+    </form>
+'''
+
+def ovsys_course_code(i):
+    return 'TMA{}'.format(4100 + i)
+
+def gen_ovsys_frontpage(codes):
+    content = ''.join(OVSYS_COURSE_LINK_TEMPLATE.format(code=code) for code in codes)
+    return OVSYS_PAGE_TEMPLATE.format(csrf_token=OVSYS_CSRF_TOKEN, content=content)
+
+def gen_ovsys_login_page():
+    return OVSYS_PAGE_TEMPLATE.format(csrf_token=OVSYS_CSRF_TOKEN, content=OVSYS_LOGIN_FORM)
+
+def gen_ovsys_course_page(code, states):
+    """states is a list of indices into OVSYS_STATUS_STRINGS, one per exercise"""
+    content = ''.join(OVSYS_EXERCISE_TEMPLATE.format(code=code, id=1000 + i, number=i + 1,
+                                                     status=OVSYS_STATUS_STRINGS[state])
+                      for i, state in enumerate(states))
+    return OVSYS_PAGE_TEMPLATE.format(csrf_token=OVSYS_CSRF_TOKEN, content=content)
+
+def gen_ovsys_fixtures():
+    """Returns a dict of name -> html for the default ovsys parse fixtures"""
+    n_states = len(OVSYS_STATUS_STRINGS)
+    return {
+        'frontpage': gen_ovsys_frontpage([ovsys_course_code(i) for i in range(8)]),
+        'small': gen_ovsys_course_page('TMA4100', [i % n_states for i in range(5)]),
+        'typical': gen_ovsys_course_page('TMA4100', [i % n_states for i in range(30)]),
+        'synthetic-500': gen_ovsys_course_page('TMA4100', [i % n_states for i in range(500)]),
+    }
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+### OVSYS REPLAY SERVER
+class OvsysReplayHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real server
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body='', headers={}):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def logged_in(self):
+        cookies = self.headers.get('Cookie', '')
+        return any(c.strip().split('=', 1)[-1] in self.server.sessions for c in cookies.split(';'))
+
+    def do_GET(self):
+        self.server.requests += 1
+        path = self.path.split('?')[0]
+        if path == '/_mutations':
+            with self.server.lock:
+                self.send(200, json.dumps(self.server.mutations))
+        elif path == '/login/' or not self.logged_in():
+            if path == '/':
+                self.send(200, gen_ovsys_login_page())
+            elif path == '/login/':
+                self.send(200, gen_ovsys_login_page())
+            else:
+                self.send(302, headers={'Location': '/login/?next=' + path})
+        elif path == '/':
+            self.send(200, gen_ovsys_frontpage(self.server.states.keys()))
+        elif path.startswith('/student/') and path.split('/')[2] in self.server.states:
+            code = path.split('/')[2]
+            with self.server.lock:
+                states = list(self.server.states[code])
+            self.send(200, gen_ovsys_course_page(code, states))
+        else:
+            self.send(404, 'Not found')
+
+    def do_POST(self):
+        self.server.requests += 1
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        if self.path != '/login/':
+            self.send(404, 'Not found')
+        elif form.get('csrfmiddlewaretoken') != [OVSYS_CSRF_TOKEN] or not form.get('username'):
+            self.send(200, gen_ovsys_login_page())
+        else:
+            session = uuid.uuid4().hex
+            self.server.sessions.add(session)
+            self.send(302, headers={'Location': form.get('next', ['/'])[0],
+                                    'Set-Cookie': 'sessionid={}; Path=/; HttpOnly'.format(session)})
+
+class OvsysReplayServer(ThreadingHTTPServer):
+    """
+    Local stand-in for ovsys serving the generated fixture pages. Every
+    mutate_every seconds the status of a random exercise moves on to the
+    next status, the changes are listed (with timestamps) at /_mutations.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, n_courses, n_exercises, mutate_every=None, address=('127.0.0.1', 0)):
+        super().__init__(address, OvsysReplayHandler)
+        self.states = {ovsys_course_code(i): [0] * n_exercises for i in range(n_courses)}
+        self.mutate_every = mutate_every
+        self.mutations = []
+        self.sessions = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def mutate(self):
+        code = random.choice(list(self.states.keys()))
+        states = self.states[code]
+        i = random.randrange(len(states))
+        with self.lock:
+            states[i] = (states[i] + 1) % len(OVSYS_STATUS_STRINGS)
+            self.mutations.append([time.time(), code, str(1000 + i)])
+
+    def mutate_forever(self):
+        while True:
+            time.sleep(self.mutate_every)
+            self.mutate()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        if self.mutate_every:
+            threading.Thread(target=self.mutate_forever, daemon=True).start()
+        return self
+
+def run_ovsys_replay_server(n_courses, n_exercises, mutate_every, port_queue):
+    server = OvsysReplayServer(n_courses, n_exercises, mutate_every)
+    port_queue.put(server.server_address[1])
+    server.start()
+    while True:
+        time.sleep(3600)
+
+def start_ovsys_replay_process(n_courses, n_exercises, mutate_every=None):
+    """Runs the replay server in another process, so it does not compete with the client for the GIL"""
+    ctx = multiprocessing.get_context('spawn')
+    port_queue = ctx.Queue()
+    process = ctx.Process(target=run_ovsys_replay_server, args=(n_courses, n_exercises, mutate_every, port_queue), daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:{}'.format(port_queue.get())
+
+### OVSYS LOAD
+def ovsys_load_login(base_url, jobs, latencies, adapter=None):
+    import ovsys
+    ovsys.ovsys.set_base_url(base_url)
+    o = ovsys.ovsys(adapter)
+    assert o.restore_or_login('student', 'hunter2', pool_size=jobs)
+    o.session.hooks['response'].append(lambda r, *args, **kwargs: latencies.append(r.elapsed.total_seconds()))
+    return o
+
+def bench_ovsys_ls(base_url, jobs):
+    """What `ovsys ls -a` does, minus the rendering"""
+    import ovsys
+    latencies = []
+    start = time.perf_counter()
+    o = ovsys_load_login(base_url, jobs, latencies)
+    matches = ovsys.get_matches(o, [])
+    for exercises in o.get_classes_exercises(matches, jobs):
+        pass
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies
+
+def bench_ovsys_daemon(base_url, jobs, duration, min_interval, max_interval, rate):
+    """Runs the daemon for duration seconds, returns the time it took to detect each change"""
+    import ovsys
+    import requests
+    latencies = []
+    detected = {}
+    o = ovsys_load_login(base_url, jobs, latencies)
+    matches = ovsys.get_matches(o, [])
+
+    def on_changes(name, url, changes):
+        for change in changes:
+            detected.setdefault((ovsys.ovsys.class_url_to_code(url), change['id']), []).append(time.time())
+
+    daemon = ovsys.Daemon(ovsys.SnapshotStore(), jobs=jobs, rate=rate)
+    daemon.add_account(o, 'student', ovsys.PollScheduler(matches, min_interval, max_interval), on_changes=on_changes)
+
+    async def run():
+        try:
+            await asyncio.wait_for(daemon.run_async(), duration)
+        except asyncio.TimeoutError:
+            pass
+    start = time.time()
+    asyncio.run(run())
+    daemon.executor.shutdown()
+
+    # Match every detection with the earliest mutation of that exercise
+    # that happened after the daemon started
+    mutations = requests.get(base_url + '/_mutations').json()
+    detect_times = []
+    undetected = 0
+    for t, code, ex_id in mutations:
+        if t < start:
+            continue
+        times = [d for d in detected.get((code, ex_id), []) if d >= t]
+        if times:
+            detect_times.append(times[0] - t)
+            detected[(code, ex_id)].remove(times[0])
+        else:
+            undetected += 1
+    return latencies, detect_times, undetected
+
+def bench_ovsys_load(course_counts, n_exercises, mutate_every, duration, min_interval, max_interval, rate, jobs):
+    print('{:<7} {:<7} {:>9} {:>9} {:>9} {:>9} {:>11} {:>11} {:>10} {:>9}'.format(
+        'Courses', 'Path', 'Requests', 'Req/s', 'p50 (ms)', 'p99 (ms)', 'Detect p50', 'Detect max', 'Undetected', 'RSS (MiB)'))
+    row = '{:<7} {:<7} {:>9} {:>9.1f} {:>9.2f} {:>9.2f} {:>11} {:>11} {:>10} {:>9.1f}'
+    for n_courses in course_counts:
+        process, base_url = start_ovsys_replay_process(n_courses, n_exercises)
+        elapsed, latencies = bench_ovsys_ls(base_url, jobs)
+        print(row.format(n_courses, 'ls -a', len(latencies), len(latencies) / elapsed,
+                         percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                         '-', '-', '-', proc_status_kib('VmRSS') / 1024))
+        process.terminate()
+
+        process, base_url = start_ovsys_replay_process(n_courses, n_exercises, mutate_every)
+        latencies, detect_times, undetected = bench_ovsys_daemon(base_url, jobs, duration, min_interval, max_interval, rate)
+        print(row.format(n_courses, 'daemon', len(latencies), len(latencies) / duration,
+                         percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                         '{:.2f}s'.format(percentile(detect_times, 50)),
+                         '{:.2f}s'.format(max(detect_times, default=float('nan'))),
+                         undetected, proc_status_kib('VmRSS') / 1024))
+        process.terminate()
+
+### ARCHNEWS
+RSS_FEED_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+  <channel>
+    <title>{title}</title>
+    <link>https://archlinux.org/news/</link>
+    <description>{title}</description>
+{items}  </channel>
+</rss>
+'''
+
+RSS_ITEM_TEMPLATE = '''    <item>
+      <title>{title} item {i}</title>
+      <link>https://archlinux.org/news/{slug}-{i}/</link>
+      <description>{description}</description>
+      <pubDate>{date}</pubDate>
+      <guid isPermaLink="false">tag:archlinux.org,2026:/news/{slug}-{i}/</guid>
+    </item>
+'''
+
+def gen_rss_feed(n_items, title='Arch Linux: Recent news updates', start=None, step=timedelta(days=3)):
+    """A feed of n_items items, newest (published at start) first"""
+    start = start or datetime(2026, 10, 1, 12, tzinfo=timezone.utc)
+    slug = title.split(':')[0].lower().replace(' ', '-')
+    description = '&lt;p&gt;{}&lt;/p&gt;'.format('Lorem ipsum dolor sit amet. ' * 60)
+    items = ''.join(RSS_ITEM_TEMPLATE.format(title=title, slug=slug, i=i, description=description,
+                                             date=format_datetime(start - i * step))
+                    for i in range(n_items))
+    return RSS_FEED_TEMPLATE.format(title=title, items=items).encode()
+
+class StaticHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.pages.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StaticServer(ThreadingHTTPServer):
+    """Serves pages, a dict of path -> bytes"""
+    daemon_threads = True
+
+    def __init__(self, pages, address=('127.0.0.1', 0)):
+        super().__init__(address, StaticHandler)
+        self.pages = pages
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading early are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def url(self, path):
+        return 'http://{}:{}{}'.format(*self.server_address, path)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def archnews_soup(url, limit):
+    """How archnews used to do it: download and parse everything, then slice"""
+    from bs4 import BeautifulSoup
+    import requests
+    soup = BeautifulSoup(requests.get(url).text, 'xml')
+    return [[i.pubDate.text, i.title.text, i.link.text] for i in soup.find_all('item')[:limit]]
+
+def archnews_stream(url, limit):
+    import archnews
+    import httpcache
+    return archnews.fetch_items(httpcache.HTTPCache(None), url, 0, limit)
+
+def bench_archnews_parse(item_counts, limit, number):
+    feeds = {'/{}'.format(n): gen_rss_feed(n) for n in item_counts}
+    server = StaticServer(feeds).start()
+    print('{:<8} {:<7} {:>10} {:>12} {:>15}'.format('Items', 'Parser', 'Feed (KiB)', 'Time (ms)', 'Peak mem (KiB)'))
+    for n in item_counts:
+        url = server.url('/{}'.format(n))
+        if archnews_soup(url, limit) != [item[:3] for item in archnews_stream(url, limit)]:
+            print('{}: parsers disagree!'.format(n), file=sys.stderr)
+            return False
+        for name, fn in [('soup', archnews_soup), ('stream', archnews_stream)]:
+            times = []
+            for _ in range(number):
+                start = time.perf_counter()
+                fn(url, limit)
+                times.append(time.perf_counter() - start)
+            peak = peak_memory_kib(fn, url, limit)
+            print('{:<8} {:<7} {:>10} {:>12.2f} {:>15}'.format(n, name, len(feeds['/{}'.format(n)]) // 1024,
+                                                               percentile(times, 50) * 1000, peak))
+    server.shutdown()
+    return True
+
+### TABLES
+def gen_table_rows(n_rows):
+    for i in range(n_rows):
+        yield [ovsys_course_code(i % 500), 'Øving {}'.format(i % 30 + 1),
+               OVSYS_STATUS_STRINGS[i % len(OVSYS_STATUS_STRINGS)], i]
+
+def print_rows_list(rows, header=None):
+    """How print_rows used to do it: align every row before printing"""
+    srows = ([[str(c) for c in header]] if header else []) + [[str(c) for c in row] for row in rows]
+    widths = {}
+    for r in srows:
+        for i, c in enumerate(r):
+            widths[i] = max(widths.get(i, 0), len(c))
+    aligned = [' '.join('{0:<{1}}'.format(c, widths[i]) for i, c in enumerate(r)) for r in srows]
+    for line in aligned:
+        print(line, '')
+
+class FirstWriteTimer:
+    """Discards what is written, remembering when the first write happened"""
+    def __init__(self):
+        self.first = None
+
+    def write(self, s):
+        if self.first is None:
+            self.first = time.perf_counter()
+        return len(s)
+
+    def flush(self):
+        pass
+
+def table_render(renderer, n_rows):
+    """Returns (time to first line, total time, peak memory), run in a fresh process"""
+    import ovsys
+    ovsys.ArgFlags.pretty = True
+    header = ['Course', 'Exercise', 'Status', 'Id']
+    if renderer == 'list':
+        render = lambda: print_rows_list(gen_table_rows(n_rows), header=header)
+    else:
+        render = lambda: ovsys.print_rows(gen_table_rows(n_rows), header=header)
+
+    out = FirstWriteTimer()
+    sys.stdout = out
+    try:
+        start = time.perf_counter()
+        render()
+        elapsed = time.perf_counter() - start
+        peak = peak_memory_kib(render)
+    finally:
+        sys.stdout = sys.__stdout__
+    return out.first - start, elapsed, peak
+
+def bench_table(n_rows):
+    print('{:<10} {:>8} {:>16} {:>14} {:>15}'.format('Renderer', 'Rows', 'First line (ms)', 'Total (ms)', 'Peak mem (KiB)'))
+    for renderer in ['list', 'stream']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            first, elapsed, peak = executor.submit(table_render, renderer, n_rows).result()
+        print('{:<10} {:>8} {:>16.2f} {:>14.1f} {:>15}'.format(renderer, n_rows, first * 1000, elapsed * 1000, peak))
+
+### STARTUP
+STARTUP_COMMANDS = [
+    ['ovsys.py', '--help'],
+    ['archnews.py', '--help'],
+    ['ontime.py', '--help'],
+]
+
+def import_times(stderr):
+    """{module: cumulative microseconds} of the top level imports in -X importtime output"""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            times[name.strip()] = int(cumulative)
+    return times
+
+def measure_startup(command):
+    """Returns (wall time, {module: import time}) of running command"""
+    import subprocess
+    start = time.perf_counter()
+    r = subprocess.run([sys.executable, '-X', 'importtime'] + command,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - start, import_times(r.stderr)
+
+def bench_startup(number, budget):
+    baseline = [measure_startup(['-c', 'pass']) for _ in range(number)]
+    base_wall = percentile([wall for wall, _ in baseline], 50)
+    base_imports = set(baseline[0][1])
+
+    ok = True
+    print('{:<22} {:>10} {:>12} {:>8}  {}'.format('Command', 'Wall (ms)', 'Import (ms)', 'Budget', 'Slowest imports'))
+    for command in STARTUP_COMMANDS:
+        runs = [measure_startup(command) for _ in range(number)]
+        wall = percentile([wall for wall, _ in runs], 50) - base_wall
+        # The imports of the script itself, not of the interpreter
+        per_run = [{m: t for m, t in imports.items() if m not in base_imports} for _, imports in runs]
+        imported = percentile([sum(imports.values()) for imports in per_run], 50) / 1000
+        slowest = sorted(per_run[-1].items(), key=lambda mt: mt[1], reverse=True)[:3]
+        within = imported <= budget
+        ok = ok and within
+        print('{:<22} {:>10.1f} {:>12.1f} {:>8}  {}'.format(' '.join(command), wall * 1000, imported,
+                                                         'ok' if within else 'OVER',
+                                                         ', '.join('{} {:.1f}'.format(m, t / 1000) for m, t in slowest)))
+    return ok
+
+### ONTIME
+def ontime_timer_latencies(n_deadlines, use_timerfd):
+    import ontime
+    timer = ontime.DeadlineTimer(precision=1, use_timerfd=use_timerfd)
+    if use_timerfd and timer.fileno() is None:
+        return None
+    latencies = []
+    for _ in range(n_deadlines):
+        deadline = time.time() + random.uniform(0.01, 0.1)
+        timer.wait(deadline)
+        latencies.append(time.time() - deadline)
+    return latencies
+
+def ontime_daemon_latencies(n_jobs):
+    import ontime
+    import subprocess
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        socket_path = os.path.join(d, 'ontime.sock')
+        log_dir = os.path.join(d, 'logs')
+        daemon = subprocess.Popen([sys.executable, 'ontime.py', '--socket', socket_path, '--log-dir', log_dir,
+                                   '--journal', os.path.join(d, 'jobs.journal'),
+                                   '--metrics', os.path.join(d, 'metrics.jsonl'), 'daemon'],
+                                  stderr=subprocess.DEVNULL)
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        deadlines = {}
+        at = time.time() + 0.5
+        for _ in range(n_jobs):
+            at += random.uniform(0.01, 0.1)
+            job = ontime.request(socket_path, {'cmd': 'add', 'at': at, 'command': "date '+%s.%N'"})['job']
+            deadlines[job['id']] = job['at']
+        time.sleep(max(0, at - time.time()) + 0.5)
+        daemon.terminate()
+        daemon.wait()
+
+        latencies = []
+        for job_id, at in deadlines.items():
+            try:
+                with open(os.path.join(log_dir, 'job-{}.log'.format(job_id))) as f:
+                    latencies.append(float(f.read()) - at)
+            except (OSError, ValueError):
+                pass
+        return latencies
+
+def bench_ontime_latency(n_deadlines):
+    print('{:<22} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('Waiting with', 'Fired', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)'))
+    for name, latencies in [('timerfd', ontime_timer_latencies(n_deadlines, True)),
+                            ('clock checks', ontime_timer_latencies(n_deadlines, False)),
+                            ('daemon, incl. start', ontime_daemon_latencies(n_deadlines))]:
+        if latencies is None:
+            print('{:<22} {:>6}'.format(name, 'n/a'))
+            continue
+        print('{:<22} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            name, len(latencies), *(percentile(latencies, p) * 1000 for p in (50, 90, 99, 100))))
+
+### KV
+KV_SH_MAX_KEYS = 10000
+
+def kv_write_store(path, n_keys):
+    """Writes a store of n_keys keys like build_org_files.sh makes, without going through kv"""
+    with open(path, 'w') as f:
+        for i in range(n_keys):
+            f.write('/home/user/org/notes/{0:07d}.org={1}\n'.format(i, uuid.UUID(int=i).hex))
+
+def kv_random_key(n_keys):
+    return '/home/user/org/notes/{0:07d}.org'.format(random.randrange(n_keys))
+
+def kv_op_latencies(kv, n_keys, number):
+    gets, sets = [], []
+    for _ in range(number):
+        key = kv_random_key(n_keys)
+        start = time.perf_counter()
+        kv.get(key)
+        gets.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        kv.set(key, uuid.uuid4().hex)
+        sets.append(time.perf_counter() - start)
+    return gets, sets
+
+def kv_prefix_latencies(kv, n_keys, number):
+    """Latencies of listing the keys, and the keys and values, of a prefix of 100 keys"""
+    keys, scans = [], []
+    for _ in range(number):
+        prefix = kv_random_key(n_keys)[:-6]
+        start = time.perf_counter()
+        list(kv.keys(prefix))
+        keys.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        list(kv.items(prefix))
+        scans.append(time.perf_counter() - start)
+    return keys, scans
+
+def kv_command_latencies(command, path, n_keys, number):
+    import subprocess
+    env = dict(os.environ, KV_FILE=path)
+    latencies = []
+    for _ in range(number):
+        start = time.perf_counter()
+        subprocess.run(command + ['get', kv_random_key(n_keys)], env=env, stdout=subprocess.DEVNULL, check=True)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def kv_batch_time(path, n_keys, n_ops):
+    """Time per get or set of one `kv.py batch` doing n_ops of each"""
+    import subprocess
+    commands = ''.join('get {0}\nset {0} {1}\n'.format(kv_random_key(n_keys), uuid.uuid4().hex)
+                       for _ in range(n_ops))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'kv.py', 'batch'], input=commands.encode(), env=dict(os.environ, KV_FILE=path),
+                   stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) / (2 * n_ops)
+
+def bench_kv(sizes, number):
+    import shutil
+    import tempfile
+    from kv import KV
+
+    print('{:<9} {:<14} {:>6} {:>9} {:>9} {:>9}'.format('Keys', 'Operation', 'Ops', 'p50 (µs)', 'p99 (µs)', 'max (µs)'))
+    tmp_dir = tempfile.mkdtemp(prefix='bench-kv-')
+    try:
+        for n_keys in sizes:
+            path = os.path.join(tmp_dir, 'kv-{}'.format(n_keys))
+            kv_write_store(path, n_keys)
+            start = time.perf_counter()
+            kv = KV(path)
+            indexing = time.perf_counter() - start
+            with kv:
+                gets, sets = kv_op_latencies(kv, n_keys, number)
+                keys, scans = kv_prefix_latencies(kv, n_keys, number)
+
+            results = [('get', gets), ('set', sets), ('keys <prefix>', keys), ('scan <prefix>', scans),
+                       ('kv.py get', kv_command_latencies([sys.executable, 'kv.py'], path, n_keys, number))]
+            if n_keys <= KV_SH_MAX_KEYS:
+                results.append(('kv.sh get', kv_command_latencies(['sh', 'kv.sh'], path, n_keys, number)))
+            for name, latencies in results:
+                print('{:<9} {:<14} {:>6} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                    n_keys, name, len(latencies), *(percentile(latencies, p) * 1e6 for p in (50, 99, 100))))
+            print('{:<9} {:<14} {:>6} {:>9.1f}'.format(n_keys, 'kv.py batch', 200 * number,
+                                                      kv_batch_time(path, n_keys, 100 * number) * 1e6))
+            print('{:<9} {:<14} {:>6} {:>9.1f}'.format(n_keys, 'index store', 1, indexing * 1e6))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+### ORG BUILD
+# Stands in for emacs, both as run by build_org_files.sh and as an export
+# worker of build_org_files.py: "exports" by copying the .org to the .md
+ORG_FAKE_EMACS = '''#!{python}
+import sys
+import time
+time.sleep({startup})
+
+def export(path):
+    time.sleep({export_time})
+    with open(path) as f:
+        text = f.read()
+    with open(path[:-len('.org')] + '.md', 'w') as f:
+        f.write(text)
+
+if '--eval' in sys.argv:
+    for line in sys.stdin:
+        start = time.time()
+        export(line.rstrip('\\n'))
+        sys.stdout.write('%.6f\\t\\n' % (time.time() - start))
+        sys.stdout.flush()
+else:
+    export(sys.argv[1])
+'''
+
+ORG_FILE_TEMPLATE = '''#+TITLE: Notes {0}
+#+INCLUDE: "common.org"
+
+* Heading {0}
+Some text with a [[https://example.com][link]] and *bold* words.
+'''
+
+ORG_BUILD_SH_MAX_FILES = 1000
+
+def gen_org_tree(root, n_files, files_per_dir=50):
+    """
+    Writes n_files .org files, each with an existing .md, in subdirectories
+    of root. The files of a directory include its common.org.
+    """
+    for i in range(n_files):
+        # build_org_files.sh only looks in subdirectories
+        directory = os.path.join(root, 'notes', 'd{:03d}'.format(i // files_per_dir))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'common.org'), 'w') as f:
+                f.write('Shared by the notes in {}\n'.format(directory))
+        path = os.path.join(directory, 'n{:05d}.org'.format(i))
+        with open(path, 'w') as f:
+            f.write(ORG_FILE_TEMPLATE.format(i))
+        open(path[:-len('.org')] + '.md', 'w').close()
+
+def org_build_time(command, root, env=None):
+    """Time of a build from scratch"""
+    for name in ('.kv', '.kv.idx', '.org-manifest.json'):
+        if os.path.exists(os.path.join(root, name)):
+            os.remove(os.path.join(root, name))
+    return org_rebuild_time(command, root, env)
+
+def org_rebuild_time(command, root, env=None, before=None):
+    import subprocess
+    if before:
+        before()
+    start = time.perf_counter()
+    subprocess.run(command, cwd=root, env=env, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def bench_org_build(n_files, startup, export_time, jobs):
+    import shutil
+    import stat
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-org-build-')
+    try:
+        bin_dir = os.path.join(tmp_dir, 'bin')
+        os.makedirs(bin_dir)
+        emacs = os.path.join(bin_dir, 'emacs')
+        with open(emacs, 'w') as f:
+            f.write(ORG_FAKE_EMACS.format(python=sys.executable, startup=startup, export_time=export_time))
+        kv = os.path.join(bin_dir, 'kv')
+        with open(kv, 'w') as f:
+            f.write('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable, os.path.abspath('kv.py')))
+        for path in (emacs, kv):
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+        root = os.path.join(tmp_dir, 'tree')
+        gen_org_tree(root, n_files)
+        org_paths = [os.path.join(d, name) for d, _, names in os.walk(root) for name in names if name.endswith('.org')]
+
+        def touch_all():
+            for path in org_paths:
+                os.utime(path)
+
+        def edit_include():
+            with open(os.path.join(root, 'notes', 'd000', 'common.org'), 'a') as f:
+                f.write('Edited\n')
+
+        driver = [sys.executable, os.path.abspath('build_org_files.py'), '--emacs', emacs]
+        runs = []
+        if n_files <= ORG_BUILD_SH_MAX_FILES:
+            runs.append(('build_org_files.sh', org_build_time(['bash', os.path.abspath('build_org_files.sh')], root,
+                                                              dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH']))))
+        runs += [
+            ('build_org_files.py -j 1', org_build_time(driver + ['-j', '1'], root)),
+            ('build_org_files.py -j {}'.format(jobs), org_build_time(driver + ['-j', str(jobs)], root)),
+            ('nothing to build', org_rebuild_time(driver, root)),
+            ('all touched, none changed', org_rebuild_time(driver, root, before=touch_all)),
+            ('nothing to build', org_rebuild_time(driver, root)),
+            ('one include edited', org_rebuild_time(driver + ['-j', str(jobs)], root, before=edit_include)),
+        ]
+        print('{} files, emacs startup {} s, export {} s per file'.format(n_files, startup, export_time))
+        print('{:<26} {:>9}'.format('Build', 'Time (s)'))
+        for name, seconds in runs:
+            print('{:<26} {:>9.3f}'.format(name, seconds))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def bench_org_watch(n_files, number, startup, export_time):
+    import shutil
+    import signal
+    import stat
+    import subprocess
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-org-watch-')
+    watcher = None
+    try:
+        emacs = os.path.join(tmp_dir, 'emacs')
+        with open(emacs, 'w') as f:
+            f.write(ORG_FAKE_EMACS.format(python=sys.executable, startup=startup, export_time=export_time))
+        os.chmod(emacs, os.stat(emacs).st_mode | stat.S_IXUSR)
+        root = os.path.join(tmp_dir, 'tree')
+        gen_org_tree(root, n_files)
+        org_paths = sorted(os.path.join(d, name) for d, _, names in os.walk(root)
+                           for name in names if name.startswith('n') and name.endswith('.org'))
+
+        watcher = subprocess.Popen([sys.executable, os.path.abspath('build_org_files.py'), '--emacs', emacs,
+                                    '--watch', root], stdout=subprocess.PIPE, universal_newlines=True)
+        for line in watcher.stdout:
+            if line.startswith('watching') or line.startswith('cannot watch'):
+                break
+        # Keep reading, so the watcher never blocks on a full pipe
+        threading.Thread(target=watcher.stdout.read, daemon=True).start()
+
+        latencies = []
+        for i in range(number):
+            path = random.choice(org_paths)
+            with open(path, 'a') as f:
+                f.write('Edit {}\n'.format(i))
+            start = time.perf_counter()
+            with open(path) as f:
+                text = f.read()
+            while True:
+                with open(path[:-len('.org')] + '.md') as f:
+                    if f.read() == text:
+                        break
+                time.sleep(0.001)
+            latencies.append(time.perf_counter() - start)
+
+        def cpu_ticks():
+            with open('/proc/{}/stat'.format(watcher.pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return int(fields[11]) + int(fields[12]) # utime, stime
+
+        idle = 5
+        before = cpu_ticks()
+        time.sleep(idle)
+        idle_ticks = cpu_ticks() - before
+
+        print('{} files, emacs startup {} s, export {} s per file'.format(n_files, startup, export_time))
+        print('Save to .md (ms): p50 {:.1f}, p90 {:.1f}, max {:.1f} over {} edits'.format(
+            *(percentile(latencies, p) * 1000 for p in (50, 90, 100)), len(latencies)))
+        print('Idle CPU: {} ticks ({} per s) in {} s'.format(idle_ticks, os.sysconf('SC_CLK_TCK'), idle))
+    finally:
+        if watcher:
+            watcher.send_signal(signal.SIGINT)
+            watcher.wait()
+        shutil.rmtree(tmp_dir)
+
+### OVSYS PARSING
+def ovsys_parse(html, parser):
+    import ovsys
+    o = ovsys.ovsys()
+    return o.parse_classes_urls(html, parser), o.parse_class_exercises(html, parser)
+
+def ovsys_parse_time(html, parser, number):
+    best = float('inf')
+    for _ in range(number):
+        start = time.perf_counter()
+        ovsys_parse(html, parser)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def proc_status_kib(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+def peak_memory_kib(fn, *args):
+    """
+    Returns how many KiB the peak RSS grows above the current RSS while
+    running fn. Measures RSS rather than using tracemalloc, which would
+    miss memory allocated by C libraries like lxml.
+    """
+    try:
+        # Resets VmHWM (the peak RSS) to the current RSS, linux only
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = proc_status_kib('VmRSS')
+        fn(*args)
+        return proc_status_kib('VmHWM') - before
+    except OSError:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn(*args)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def ovsys_parse_peak_memory(html, parser):
+    """Run in a fresh process so earlier runs do not hide the peak"""
+    ovsys_parse(gen_ovsys_fixtures()['small'], parser) # warm up imports
+    return peak_memory_kib(ovsys_parse, html, parser)
+
+def bench_ovsys_parse(fixtures, number):
+    parsers = ['bs4', 'lxml']
+    print('{:<16} {:<6} {:>12} {:>14}'.format('Fixture', 'Parser', 'Time (ms)', 'Peak mem (KiB)'))
+    for name, html in fixtures.items():
+        results = [ovsys_parse(html, parser) for parser in parsers]
+        if any(r != results[0] for r in results):
+            print('{}: extraction paths disagree!'.format(name), file=sys.stderr)
+            return False
+
+        for parser in parsers:
+            elapsed = ovsys_parse_time(html, parser, number)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                peak = executor.submit(ovsys_parse_peak_memory, html, parser).result()
+            print('{:<16} {:<6} {:>12.3f} {:>14}'.format(name, parser, elapsed * 1000, peak))
+    return True
+
+### SMTP
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost smtp sink')
+        in_data = False
+        bare_lf = False
+        lines = []
+        for line in self.rfile:
+            # Like hardened servers, refuse messages with bare LF line endings
+            bare_lf |= in_data and not line.endswith(b'\r\n')
+            line = line.rstrip(b'\r\n')
+            if in_data:
+                if line == b'.':
+                    in_data = False
+                    if bare_lf:
+                        self.reply('550 Bare LF line endings are not allowed')
+                    else:
+                        self.server.messages.append(b'\n'.join(lines))
+                        self.reply('250 OK')
+                    bare_lf = False
+                    lines = []
+                else:
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                continue
+
+            verb = line.split(b' ', 1)[0].upper()
+            if verb == b'EHLO':
+                self.reply('250-localhost\r\n250 8BITMIME')
+            elif verb == b'HELO':
+                self.reply('250 localhost')
+            elif verb in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self.reply('250 OK')
+            elif verb == b'DATA':
+                in_data = True
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif verb == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """SMTP server that keeps every message it receives in self.messages"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, SmtpSinkHandler)
+        self.connections = 0
+        self.messages = []
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def bench_ovsys_smtp(n_messages):
+    import ovsys
+    sink = SmtpSink().start()
+    config = {'email': {
+        'host': '127.0.0.1', 'port': sink.server_address[1], 'starttls': False,
+        'sender': 'ovsys@localhost', 'recipient': 'student@localhost',
+        'subject_format': 'OVSYS2: {class_code} changed',
+    }}
+    changes = [{'course': '/student/{}/'.format(ovsys_course_code(i % 8)), 'id': str(i), 'name': 'Øving {}'.format(i),
+                'old': ['Øving {}'.format(i), True, False, '----'], 'new': ['Øving {}'.format(i), True, True, 'pass']}
+               for i in range(n_messages)]
+
+    def per_message():
+        for change in changes:
+            m = ovsys.Mailer(config['email'])
+            m.send(ovsys.gen_msg(config, [change]))
+            m.close()
+
+    def persistent():
+        m = ovsys.Mailer(config['email'])
+        for change in changes:
+            m.send(ovsys.gen_msg(config, [change]))
+        m.close()
+
+    def digest():
+        queue = ovsys.NotificationQueue(config, ovsys.Mailer(config['email']), window=60)
+        for change in changes:
+            queue.add([change])
+        queue.flush(force=True)
+        queue.mailer.close()
+
+    print('{:<12} {:>10} {:>12} {:>12} {:>14}'.format('Mode', 'Changes', 'Messages', 'Connections', 'Changes/s'))
+    for name, fn in [('per-message', per_message), ('persistent', persistent), ('digest', digest)]:
+        sink.connections, sink.messages = 0, []
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        print('{:<12} {:>10} {:>12} {:>12} {:>14.1f}'.format(name, n_messages, len(sink.messages),
+                                                            sink.connections, n_messages / elapsed))
+    sink.shutdown()
+
+def main(argv):
+    args = docopt(__doc__, argv)
+
+    if args['ovsys-fixtures']:
+        os.makedirs(args['<dir>'], exist_ok=True)
+        for name, html in gen_ovsys_fixtures().items():
+            with open(os.path.join(args['<dir>'], name + '.html'), 'w') as f:
+                f.write(html)
+
+    elif args['ovsys-parse']:
+        if args['<fixture>']:
+            fixtures = {}
+            for path in args['<fixture>']:
+                with open(path) as f:
+                    fixtures[os.path.basename(path)] = f.read()
+        else:
+            fixtures = gen_ovsys_fixtures()
+        if not bench_ovsys_parse(fixtures, int(args['--number'])):
+            sys.exit(1)
+
+    elif args['ovsys-smtp']:
+        bench_ovsys_smtp(int(args['--messages']))
+
+    elif args['ovsys-replay']:
+        n_courses = int(args['--courses'].split(',')[0])
+        server = OvsysReplayServer(n_courses, int(args['--exercises']), float(args['--mutate-every']),
+                                   ('127.0.0.1', int(args['--port'])))
+        print('Listening on http://{}:{}'.format(*server.server_address))
+        server.start()
+        threading.Event().wait()
+
+    elif args['ovsys-load']:
+        bench_ovsys_load([int(n) for n in args['--courses'].split(',')], int(args['--exercises']),
+                         float(args['--mutate-every']), float(args['--duration']),
+                         float(args['--min-interval']), float(args['--max-interval']),
+                         float(args['--rate']), int(args['--jobs']))
+
+    elif args['archnews-parse']:
+        if not bench_archnews_parse([int(n) for n in args['--items'].split(',')], int(args['--limit']),
+                                    int(args['--number'])):
+            sys.exit(1)
+
+    elif args['table']:
+        bench_table(int(args['--rows']))
+
+    elif args['startup']:
+        if not bench_startup(int(args['--number']), float(args['--budget'])):
+            sys.exit(1)
+
+    elif args['ontime-latency']:
+        bench_ontime_latency(int(args['--number']))
+
+    elif args['kv']:
+        bench_kv([int(n) for n in args['--sizes'].split(',')], int(args['--number']))
+
+    elif args['org-build']:
+        bench_org_build(int(args['--files']), float(args['--emacs-startup']), float(args['--export-time']),
+                        int(args['--jobs']))
+
+    elif args['org-watch']:
+        bench_org_watch(int(args['--files']), int(args['--number']), float(args['--emacs-startup']),
+                        float(args['--export-time']))
+
+    elif args['smtp-sink']:
+        sink = SmtpSink(('127.0.0.1', int(args['--port'])))
+        print('Listening on {}:{}'.format(*sink.server_address))
+        sink.serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
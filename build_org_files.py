@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+# Author: Jørgen Bele Reinfjell
+# Date: 17.10.2026 [dd.mm.yyyy]
+# Description:
+#   Rebuilds outdated markdown files from emacs
+#   org-mode .org files, like build_org_files.sh,
+#   but exports them in parallel with long-lived
+#   emacs processes instead of starting emacs for
+#   every file.
+"""
+Usage:
+  build_org_files.py [options] [<dir>]
+
+Options:
+  -j <n>, --jobs <n>     Number of emacs processes to export with, 0 for one
+                         per CPU [default: 0]
+  --emacs <path>         The emacs to run [default: emacs]
+  -t, --timings          Print how long each file took, slowest last
+  -n, --dry-run          Only print which files would be built
+  -v, --verbose          Also print the files that are up to date, and the
+                         output of emacs
+  -w, --watch            After building, keep building the files that change
+  --debounce <seconds>   How long --watch waits for more changes after one,
+                         so a burst of saves is built once [default: 0.1]
+  --interval <seconds>   How often --watch looks for changes when inotify
+                         is not available [default: 2]
+
+Looks for .org files in <dir> (default: the current directory) and its
+subdirectories, and exports the ones that changed since they were last
+built and have a .md file next to them to markdown. A file is rebuilt
+when its content, or that of a file it includes with #+INCLUDE or
+#+SETUPFILE (recursively), differs from when it was last built. Renaming
+a file does not make it outdated.
+
+What every file was built from is kept in <dir>/.org-manifest.json, with
+the size, mtime and sha1 of the files, so that only files whose size or
+mtime changed are read and hashed. Without a manifest, the sha1sums
+build_org_files.sh stored in <dir>/.kv are used.
+
+All outdated files are found first, then handed out to the emacs
+processes, each exporting one file after another, so emacs and org are
+only loaded once per process.
+
+With --watch, the directories are watched with inotify (on linux), and
+only the changed .org files and the files including them are looked at
+and built, in the same emacs processes. Elsewhere, or when there are too
+many directories to watch, the whole tree is looked at every --interval.
+Files included from outside <dir> are only noticed when it is.
+
+Exits with status 1 if any file could not be exported.
+"""
+
+from docopt import docopt
+import hashlib
+import json
+import os
+import re
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+MANIFEST_NAME = '.org-manifest.json'
+MANIFEST_VERSION = 1
+INCLUDE_RE = re.compile(rb'^[ \t]*#\+(?:INCLUDE|SETUPFILE):[ \t]*(?:"([^"\n]+)"|(\S+))', re.IGNORECASE | re.MULTILINE)
+HASH_BUFFER_SIZE = 1024 * 1024
+# A file changed again within the same mtime tick after it was hashed looks
+# unchanged, so files changed this close to the start of the build that
+# hashed them are hashed again the next time
+MTIME_GRANULARITY_NS = 2 * 10**9
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, len
+
+# Run by each emacs: exports the files named on stdin, one per line,
+# answering each with "<seconds>\t<error message or nothing>"
+EMACS_WORKER_LOOP = r'''
+(progn
+  (require 'cl-lib)
+  (require 'ox-md)
+  (setq make-backup-files nil)
+  (let (path)
+    (while (setq path (ignore-errors (read-from-minibuffer "")))
+      (let ((start (float-time)) (err ""))
+        (condition-case e
+            (let ((buffer (find-file-noselect path)))
+              (unwind-protect
+                  ;; Questions would be answered with the next file name, say no
+                  (cl-letf (((symbol-function 'yes-or-no-p) #'ignore)
+                            ((symbol-function 'y-or-n-p) #'ignore))
+                    (with-current-buffer buffer
+                      (org-md-export-to-markdown)))
+                (kill-buffer buffer)))
+          (error (setq err (replace-regexp-in-string "[\t\n]" " " (error-message-string e)))))
+        (send-string-to-terminal (format "%.6f\t%s\n" (- (float-time) start) err))))))
+'''
+
+class ExportError(Exception):
+    pass
+
+class EmacsWorker:
+    """An emacs process exporting org files to markdown, one at a time"""
+    def __init__(self, emacs='emacs', verbose=False):
+        start = time.perf_counter()
+        self.process = subprocess.Popen([emacs, '--batch', '--eval', EMACS_WORKER_LOOP],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=None if verbose else subprocess.DEVNULL,
+                                        universal_newlines=True, bufsize=1)
+        self.started = time.perf_counter() - start
+        self.startup = None # the time until emacs answered the first file
+
+    def export(self, path):
+        """Exports path, returning how many seconds emacs spent on it"""
+        if '\n' in path:
+            raise ExportError('file names with newlines are not supported')
+        start = time.perf_counter()
+        try:
+            self.process.stdin.write(path + '\n')
+            self.process.stdin.flush()
+            answer = self.process.stdout.readline()
+        except BrokenPipeError:
+            answer = ''
+        if not answer:
+            raise ExportError('emacs exited with status {}'.format(self.process.wait()))
+        seconds, error = answer.rstrip('\n').split('\t', 1)
+        if self.startup is None:
+            self.startup = self.started + time.perf_counter() - start - float(seconds)
+        if error:
+            raise ExportError(error)
+        return float(seconds)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+
+class EmacsPool:
+    """Exports files in jobs threads, each with its own EmacsWorker"""
+    def __init__(self, jobs, emacs='emacs', verbose=False):
+        self.jobs = jobs
+        self.emacs = emacs
+        self.verbose = verbose
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.executor = None
+
+    def __worker(self):
+        worker = getattr(self.local, 'worker', None)
+        if not worker:
+            worker = self.local.worker = EmacsWorker(self.emacs, self.verbose)
+            with self.lock:
+                self.workers.append(worker)
+        return worker
+
+    def export(self, path):
+        """(path, wall seconds, emacs seconds, error or None)"""
+        start = time.perf_counter()
+        worker = self.__worker()
+        try:
+            seconds = worker.export(path)
+            return path, time.perf_counter() - start, seconds, None
+        except ExportError as e:
+            if worker.process.poll() is not None:
+                # Start a new emacs for the next file
+                self.local.worker = None
+            return path, time.perf_counter() - start, None, str(e)
+
+    def export_all(self, paths):
+        """Yields the results of export() for paths as they finish"""
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        if not self.executor:
+            # Kept between calls, the emacs processes belong to its threads
+            self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        futures = [self.executor.submit(self.export, p) for p in paths]
+        try:
+            yield from (f.result() for f in as_completed(futures))
+        finally:
+            # Interrupted, do not wait for the rest
+            for f in futures:
+                f.cancel()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+        for worker in self.workers:
+            worker.close()
+
+def sha1_file(path):
+    h = hashlib.sha1()
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        for n in iter(lambda: f.readinto(buf), 0):
+            h.update(view[:n])
+    return h.hexdigest()
+
+def includes(path):
+    """The files path includes with #+INCLUDE or #+SETUPFILE"""
+    with open(path, 'rb') as f:
+        text = f.read()
+    directory = os.path.dirname(path)
+    for m in INCLUDE_RE.finditer(text):
+        name = os.fsdecode(m.group(1) or m.group(2))
+        if '://' in name:
+            # A remote setup file, not tracked
+            continue
+        yield os.path.normpath(os.path.join(directory, os.path.expanduser(name)))
+
+class Manifest:
+    """
+    What the last build of every .org file in root was made from: the sha1
+    of the file and the files it includes (its inputs). The sha1 of a file
+    is reused until its size or mtime changes. Paths are stored relative to
+    root.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.prefix = os.path.join(root, '')
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self.started = time.time_ns()
+        self.files = {}  # path -> [size, mtime_ns, sha1]
+        self.builds = {} # source path -> {input path: sha1 or None if missing}
+        self.trusted_before = 0
+        self.hashed = {} # path -> sha1, of this run
+        self.by_sha1 = None
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.files = data['files']
+                self.builds = data['builds']
+                self.trusted_before = data['started'] - MTIME_GRANULARITY_NS
+        except FileNotFoundError:
+            self.__import_kv()
+        except ValueError:
+            # Everything is rebuilt
+            pass
+
+    def __import_kv(self):
+        """Takes the sha1sums stored by build_org_files.sh as builds without includes"""
+        kv_path = os.path.join(self.root, '.kv')
+        if not os.path.isfile(kv_path):
+            return
+        from kv import KV
+        with KV(kv_path) as kv:
+            for path, value in kv.items():
+                rel = self.rel(path)
+                self.builds[rel] = {rel: value.split(' ', 1)[0]}
+        self.dirty = True
+
+    def rel(self, path):
+        # os.path.relpath is slow enough to matter with 10000s of files
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):]
+        return os.path.relpath(path, self.root)
+
+    def abs(self, rel):
+        if rel.startswith('..'):
+            return os.path.normpath(os.path.join(self.root, rel))
+        return self.prefix + rel
+
+    def sha1(self, path):
+        """The sha1 of path, or None if there is no such file"""
+        rel = self.rel(path)
+        if rel in self.hashed:
+            return self.hashed[rel]
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.hashed[rel] = None
+            return None
+        cached = self.files.get(rel)
+        if cached and cached[:2] == [st.st_size, st.st_mtime_ns] and st.st_mtime_ns < self.trusted_before:
+            digest = cached[2]
+        else:
+            digest = sha1_file(path)
+            self.files[rel] = [st.st_size, st.st_mtime_ns, digest]
+            self.dirty = True
+        self.hashed[rel] = digest
+        return digest
+
+    def forget(self, path=None):
+        """Makes the next sha1(path) look at the file again, or at every file if None"""
+        if path is None:
+            self.hashed.clear()
+        else:
+            self.hashed.pop(self.rel(path), None)
+
+    def dependents(self, paths):
+        """The sources whose last build used any of paths"""
+        rels = {self.rel(path) for path in paths}
+        return {self.abs(source) for source, build in self.builds.items() if not rels.isdisjoint(build)}
+
+    def inputs(self, source):
+        """{path: sha1} of source and everything it includes, recursively"""
+        inputs = {}
+        pending = [source]
+        while pending:
+            path = pending.pop()
+            rel = self.rel(path)
+            if rel in inputs:
+                continue
+            inputs[rel] = self.sha1(path)
+            if inputs[rel] is not None:
+                pending.extend(includes(path))
+        return inputs
+
+    def outdated(self, source):
+        build = self.builds.get(self.rel(source))
+        if build is None:
+            return not self.__renamed(source)
+        return any(self.sha1(self.abs(rel)) != digest for rel, digest in build.items())
+
+    def __renamed(self, source):
+        """Takes over the build of a file with the same content that is gone, as it was renamed to source"""
+        if self.by_sha1 is None:
+            self.by_sha1 = {build.get(rel): rel for rel, build in self.builds.items()}
+        old = self.by_sha1.get(self.sha1(source))
+        if not old or old not in self.builds or os.path.exists(self.abs(old)):
+            return False
+        build = self.builds.pop(old)
+        if any(self.sha1(self.abs(rel)) != digest for rel, digest in build.items() if rel != old):
+            self.builds[old] = build
+            return False
+        new = self.rel(source)
+        self.builds[new] = {(new if rel == old else rel): digest for rel, digest in build.items()}
+        self.dirty = True
+        return True
+
+    def built(self, source, inputs):
+        self.builds[self.rel(source)] = inputs
+        self.dirty = True
+
+    def prune(self, sources):
+        """Forgets the files not used by the builds of sources"""
+        keep = {self.rel(source) for source in sources}
+        builds = {rel: build for rel, build in self.builds.items() if rel in keep}
+        used = {rel for build in builds.values() for rel in build}
+        files = {rel: f for rel, f in self.files.items() if rel in used}
+        if len(builds) != len(self.builds) or len(files) != len(self.files):
+            self.builds, self.files = builds, files
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {'version': MANIFEST_VERSION, 'started': self.started, 'files': self.files, 'builds': self.builds}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            # dumps uses the C encoder, dump does not
+            f.write(json.dumps(data, separators=(',', ':')))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+class Inotify:
+    """Watches directories for changed files with inotify, through ctypes"""
+    def __init__(self):
+        import ctypes
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.libc.inotify_init1, self.libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError('inotify is not available')
+        self.get_errno = ctypes.get_errno
+        self.fd = self.__check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.directories = {} # watch descriptor -> path
+
+    def __check(self, result):
+        if result < 0:
+            errno = self.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def fileno(self):
+        return self.fd
+
+    def watch_tree(self, root):
+        """Watches root and its subdirectories, skipping hidden ones"""
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            try:
+                wd = self.__check(self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK))
+            except FileNotFoundError:
+                # Removed since it was listed
+                continue
+            self.directories[wd] = dirpath
+
+    def read(self):
+        """
+        (path, mask) of the events that have arrived. The path is None if
+        events were lost, as the kernel queue overflowed.
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif mask & IN_IGNORED:
+                # The directory is gone
+                self.directories.pop(wd, None)
+            elif wd in self.directories:
+                events.append((os.path.join(self.directories[wd], name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def wait_for_changes(inotify, debounce):
+    """
+    Waits for files to change, returning their paths once nothing has
+    changed for debounce seconds, or None if changes may have been lost.
+    New directories are watched, and the files in them count as changed.
+    """
+    changed = set()
+    timeout = None
+    while select.select([inotify], [], [], timeout)[0]:
+        for path, mask in inotify.read():
+            if path is None:
+                return None
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith('.'):
+                try:
+                    inotify.watch_tree(path)
+                except OSError:
+                    # Out of watches (ENOSPC), rescan instead
+                    return None
+                # Created before the watch was
+                changed.update(os.path.join(d, name) for d, _, names in os.walk(path) for name in names)
+        timeout = debounce
+    return changed
+
+def sources(root):
+    """The .org files with a .md file next to them in root and its subdirectories, skipping hidden ones"""
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError:
+            continue
+        names = {e.name for e in entries}
+        subdirectories = []
+        for e in entries:
+            if e.name.startswith('.'):
+                continue
+            if e.is_dir(follow_symlinks=False):
+                subdirectories.append(e.path)
+            elif e.name.endswith('.org') and markdown_path(e.name) in names:
+                yield e.path
+        pending.extend(reversed(subdirectories))
+
+def markdown_path(path):
+    return path[:-len('.org')] + '.md'
+
+def outdated_sources(manifest, sources, verbose=False):
+    """(source, inputs) of the sources that changed since they were built"""
+    outdated = []
+    for source in sources:
+        if manifest.outdated(source):
+            outdated.append((source, manifest.inputs(source)))
+        elif verbose:
+            print('{}: SKIPPING'.format(source))
+    return outdated
+
+def build(manifest, pool, outdated):
+    """Exports the outdated sources, returning the results of EmacsPool.export()"""
+    inputs = dict(outdated)
+    results = []
+    try:
+        for path, wall, seconds, error in pool.export_all(list(inputs)):
+            results.append((path, wall, seconds, error))
+            if error:
+                print('{}: FAILED: {}'.format(path, error), file=sys.stderr)
+                continue
+            print('{}: built {} in {:.3f} s'.format(path, markdown_path(path), wall))
+            manifest.built(path, inputs[path])
+    finally:
+        manifest.save()
+    return results
+
+def is_source(path):
+    name = os.path.basename(path)
+    return (name.endswith('.org') and not name.startswith('.') and os.path.isfile(path)
+            and os.path.isfile(markdown_path(path)))
+
+def watch(manifest, pool, root, found, debounce, interval, verbose=False):
+    """Builds the sources under root as they change, forever"""
+    try:
+        inotify = Inotify()
+        inotify.watch_tree(root)
+        print('watching {} directories for changes'.format(len(inotify.directories)))
+    except OSError as e:
+        print('cannot watch {} ({}), looking for changes every {} s'.format(root, e.strerror or e, interval),
+              file=sys.stderr)
+        inotify = None
+    sys.stdout.flush()
+
+    while True:
+        if inotify:
+            changed = wait_for_changes(inotify, debounce)
+        else:
+            time.sleep(interval)
+            changed = None
+        start = time.perf_counter()
+        manifest.started = time.time_ns()
+
+        if changed is None:
+            if inotify:
+                # Directories may have been created while events were lost
+                try:
+                    inotify.watch_tree(root)
+                except OSError as e:
+                    print('cannot watch every directory ({}), changes in some may be missed'.format(e.strerror or e),
+                          file=sys.stderr)
+            manifest.forget()
+            found = set(sources(root))
+            candidates = found
+        else:
+            for path in list(changed):
+                manifest.forget(path)
+                if path in found or path.endswith('.org') or path.endswith('.md'):
+                    # A .org file or its .md may have come or gone
+                    source = path[:-len('.md')] + '.org' if path.endswith('.md') else path
+                    if is_source(source):
+                        found.add(source)
+                        changed.add(source)
+                    else:
+                        found.discard(source)
+                elif not os.path.exists(path):
+                    # Maybe a directory that was removed
+                    prefix = os.path.join(path, '')
+                    found.difference_update([source for source in found if source.startswith(prefix)])
+            candidates = (changed | manifest.dependents(changed)) & found
+
+        outdated = outdated_sources(manifest, sorted(candidates), verbose)
+        manifest.prune(found)
+        if not outdated:
+            manifest.save()
+            continue
+        results = build(manifest, pool, outdated)
+        failed = sum(1 for r in results if r[3])
+        print('built {} of {} files in {:.3f} s'.format(len(results) - failed, len(results),
+                                                       time.perf_counter() - start))
+        sys.stdout.flush()
+
+def print_timings(results):
+    print('{:>9} {:>9}  {}'.format('Wall (s)', 'Emacs (s)', 'File'))
+    for path, wall, seconds, error in sorted(results, key=lambda r: r[1]):
+        print('{:>9.3f} {:>9}  {}'.format(wall, 'failed' if error else '{:.3f}'.format(seconds), path))
+
+def main(argv):
+    args = docopt(__doc__, argv)
+    root = os.path.abspath(args['<dir>'] or '.')
+    jobs = int(args['--jobs']) or os.cpu_count() or 1
+    verbose = args['--verbose']
+
+    start = time.perf_counter()
+    manifest = Manifest(root)
+    found = list(sources(root))
+    outdated = outdated_sources(manifest, found, verbose)
+    manifest.prune(found)
+    scanned = time.perf_counter() - start
+    if args['--dry-run']:
+        for path, _ in outdated:
+            print('{}: would build {}'.format(path, markdown_path(path)))
+        return 0
+    if not outdated:
+        manifest.save()
+        print('no changes detected')
+        if not args['--watch']:
+            return 0
+
+    # Emacs is only started once there is something to export
+    pool = EmacsPool(jobs if args['--watch'] else min(jobs, len(outdated)), args['--emacs'], verbose)
+    failed = 0
+    try:
+        if outdated:
+            results = build(manifest, pool, outdated)
+            if args['--timings']:
+                print_timings(results)
+            failed = sum(1 for r in results if r[3])
+            startups = [w.startup for w in pool.workers if w.startup is not None]
+            print('built {} of {} files in {:.3f} s with {} emacs ({:.3f} s finding them, {:.3f} s average emacs startup)'.format(
+                len(results) - failed, len(results), time.perf_counter() - start, len(pool.workers), scanned,
+                sum(startups) / len(startups) if startups else 0))
+        if args['--watch']:
+            watch(manifest, pool, root, set(found), float(args['--debounce']), float(args['--interval']), verbose)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
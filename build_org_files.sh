@@ -6,9 +6,15 @@
 #   from emacs org-mode .org files. It recursively
 #   builds all .org files it finds and stores the
 #   sha1sum of the file to compare with later.
-#   Requires kv.sh as kv
+#   Requires kv.py as kv
 build_orgfiles() {
     local r=0
+    # Look up the hashes of every file in the directory with a single kv
+    for infile in *.org; do
+        printf 'get %s/%s\n' "$1" "$infile"
+    done | kv batch > "$OLDHASHES"
+    exec 3< "$OLDHASHES"
+
     for infile in *.org; do
         if [ "$infile" == "*.org" ]; then
             return
@@ -17,13 +23,15 @@ build_orgfiles() {
 
         local key="$1/$infile"
         local curhash=`sha1sum "$infile"`
-        local oldhash=`kv get "$key"`
+        local oldhash
+        read -r oldhash <&3
 
         if ! [ "$oldhash" = "$curhash" ] && [ -f "$ofile" ]; then
             echo "$1/$infile: building $1/$ofile"
             # pandoc -o "$ofile" "$infile"
             emacs "$infile" --batch -f org-md-export-to-markdown --kill
-            kv set "${key}" "$curhash"
+            # Stored by a single kv at the end
+            printf 'set\0%s\0%s\0' "$key" "$curhash" >> "$NEWHASHES"
             r=1
         else
             echo "$1/$infile: SKIPPING"
@@ -47,4 +55,11 @@ recursive_build() {
 
 export KV_FILE="$PWD/.kv"
 kv init > /dev/null
-recursive_build "$PWD" && echo "no changes detected"
+OLDHASHES=`mktemp`
+NEWHASHES=`mktemp`
+trap 'rm -f "$OLDHASHES" "$NEWHASHES"' EXIT
+recursive_build "$PWD"
+built=$? # 1 if anything was built
+[ "$built" = 0 ] && echo "no changes detected"
+kv batch -0 < "$NEWHASHES"
+exit "$built"
@@ -0,0 +1,267 @@
+# Author: Jørgen Bele Reinfjell
+# Date: 17.10.2026 [dd.mm.yyyy]
+# Description:
+#   Shared on-disk HTTP cache used by archnews, ovsys
+#   and fsweb. Responses are revalidated using ETag and
+#   Last-Modified, and the parsed result of a response is
+#   cached next to it so an unchanged page is never parsed
+#   twice.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from profiling import profiler
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/utils-http')
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024 # bytes
+# Eviction goes down to this fraction of max_size, so that a full cache
+# is not scanned again on every store
+EVICT_TO = 0.9
+
+class OfflineCacheMiss(Exception):
+    pass
+
+class CachedResponse:
+    """
+    The parts of a requests.Response the tools use, plus the parsed result.
+    Streamed responses have no text, the body is read from raw, and the
+    response closed (with close() or a with block) when done.
+    """
+    def __init__(self, url, status_code, text, parsed=None, from_cache=False, response=None, raw=None):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.parsed = parsed
+        self.from_cache = from_cache
+        self.response = response
+        self.raw = raw
+
+    def close(self):
+        if self.raw is not None and hasattr(self.raw, 'finish'):
+            self.raw.finish()
+        if self.response is not None:
+            self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            import requests
+            raise requests.HTTPError('{} for url: {}'.format(self.status_code, self.url))
+
+class TeeReader:
+    """
+    Reads a streamed body, keeping a copy of it. on_end(content) is called
+    with the whole body once it has been read, finish() reads what is left.
+    """
+    def __init__(self, raw, on_end):
+        self.raw = raw
+        self.on_end = on_end
+        self.chunks = []
+        self.ended = False
+
+    def read(self, size=-1):
+        data = self.raw.read(None if size is None or size < 0 else size)
+        self.chunks.append(data)
+        if not data or size is None or size < 0:
+            self.__end()
+        return data
+
+    def tell(self):
+        return self.raw.tell()
+
+    def finish(self):
+        while not self.ended:
+            self.read(64 * 1024)
+
+    def __end(self):
+        if not self.ended:
+            self.ended = True
+            self.on_end(b''.join(self.chunks))
+
+class HTTPCache:
+    """
+    Size bounded (LRU) cache of GET responses in path, one json file per
+    url. A path of None disables the cache, every fetch goes to the server.
+    In offline mode nothing is fetched, entries are served however old.
+    """
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE, offline=False):
+        self.path = path
+        self.max_size = max_size
+        self.offline = offline
+        # The total size of the entries, as far as this process knows.
+        # Others may write too, so it is recounted by every evict()
+        self.size = None
+        self.size_lock = threading.Lock()
+
+    def __entry_path(self, url, namespace):
+        key = hashlib.sha1('{}\0{}'.format(namespace, url).encode()).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+    def __load(self, entry_path):
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used for the LRU eviction
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            # Evicted by another thread or process since it was read
+            pass
+        return entry
+
+    def __store(self, entry_path, entry):
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        # Unique, as other threads and processes may store the same url
+        tmp_path = '{}.{}.{}.tmp'.format(entry_path, os.getpid(), threading.get_ident())
+        # Entries may hold pages only the logged in user should see
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f, separators=(',', ':'))
+        size = os.stat(tmp_path).st_size
+        try:
+            replaced = os.stat(entry_path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, entry_path)
+        with self.size_lock:
+            if self.size is not None:
+                self.size += size - replaced
+            full = self.size is None or self.size > self.max_size
+        if full:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        EVICT_TO of max_size, when it is larger than max_size
+        """
+        entries = []
+        total = 0
+        for e in os.scandir(self.path):
+            if e.name.endswith('.json'):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    # Evicted by another thread or process
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+        if total > self.max_size:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Evicted by another thread or process
+                    pass
+                total -= size
+        with self.size_lock:
+            self.size = total
+
+    def __parsed(self, entry, parse, parse_key, url):
+        if not parse:
+            return None
+        with profiler.phase('parse', url=url) as phase:
+            phase['cached'] = parse_key in entry['parsed']
+            if not phase['cached']:
+                entry['parsed'][parse_key] = parse(entry['body'])
+        return entry['parsed'][parse_key]
+
+    def fetch(self, url, session=None, headers=None, ttl=0, parse=None, parse_key=None, namespace='', cacheable=None,
+              stream=False, timeout=None):
+        """
+        GETs url, returning a CachedResponse. An entry younger than ttl
+        seconds is used without asking the server. Otherwise the request
+        is made conditional on the cached ETag/Last-Modified, and when the
+        server answers 304 (or sends an identical body) the cached parsed
+        result is reused instead of calling parse(text) again.
+        namespace separates the entries of eg. different users, and
+        responses for which cacheable(response) is false are not stored.
+        With stream, a response that has to be downloaded is read by the
+        caller from .raw, which closes it when done. It is not parsed, and
+        is stored once it has been read: when the caller stops early,
+        closing it reads the rest, so that the entry can be used later.
+        """
+        if parse and not parse_key:
+            parse_key = parse.__qualname__
+        if not session:
+            # Imported here as requests is slow to import
+            import requests
+            session = requests
+        headers = dict(headers or {})
+
+        entry_path = self.__entry_path(url, namespace) if self.path else None
+        entry = self.__load(entry_path) if entry_path else None
+
+        with profiler.phase('fetch', url=url, bytes=0) as phase:
+            phase['cached'] = bool(entry and (self.offline or time.time() - entry['fetched'] < ttl))
+            if not phase['cached']:
+                if self.offline:
+                    raise OfflineCacheMiss(url)
+                if entry:
+                    if entry['etag']:
+                        headers['If-None-Match'] = entry['etag']
+                    if entry['last_modified']:
+                        headers['If-Modified-Since'] = entry['last_modified']
+                r = session.get(url, headers=headers, stream=stream, timeout=timeout)
+                phase['status'] = r.status_code
+                if not stream:
+                    phase['bytes'] = len(r.content)
+
+        if phase['cached']:
+            return CachedResponse(entry['final_url'], 200, entry['body'], self.__parsed(entry, parse, parse_key, url), from_cache=True)
+
+        if entry and r.status_code == 304:
+            entry['fetched'] = time.time()
+            parsed = self.__parsed(entry, parse, parse_key, url)
+            self.__store(entry_path, entry)
+            return CachedResponse(entry['final_url'], 200, entry['body'], parsed, from_cache=True)
+
+        if stream:
+            r.raw.decode_content = True
+            raw = r.raw
+            if entry_path and r.status_code == 200 and not (cacheable and not cacheable(r)):
+                def on_end(content):
+                    text = content.decode(r.encoding or 'utf-8', errors='replace')
+                    self.__store_response(entry_path, entry, url, r, content, text)
+                raw = TeeReader(r.raw, on_end)
+            return CachedResponse(r.url, r.status_code, None, response=r, raw=raw)
+
+        if not entry_path or r.status_code != 200 or (cacheable and not cacheable(r)):
+            parsed = None
+            if parse:
+                with profiler.phase('parse', url=url, cached=False):
+                    parsed = parse(r.text)
+            return CachedResponse(r.url, r.status_code, r.text, parsed)
+
+        entry = self.__store_response(entry_path, entry, url, r, r.content, r.text, parse, parse_key)
+        return CachedResponse(r.url, r.status_code, entry['body'], entry['parsed'].get(parse_key), from_cache=False)
+
+    def __store_response(self, entry_path, entry, url, r, content, text, parse=None, parse_key=None):
+        """Stores the body of r in (a replacement of) entry, and returns it"""
+        body_hash = hashlib.sha1(content).hexdigest()
+        if not entry or entry['body_hash'] != body_hash:
+            entry = {'url': url, 'body': text, 'body_hash': body_hash, 'parsed': {}}
+        entry['final_url'] = r.url
+        entry['etag'] = r.headers.get('ETag')
+        entry['last_modified'] = r.headers.get('Last-Modified')
+        entry['fetched'] = time.time()
+        self.__parsed(entry, parse, parse_key, url)
+        self.__store(entry_path, entry)
+        return entry
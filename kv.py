@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# Author: Jørgen Bele Reinfjell
+# Date: 17.10.2026 [dd.mm.yyyy]
+# Description:
+#   kv is a key-value store using
+#   a locally backed file. Replaces
+#   kv.sh, without rescanning the
+#   file on every call.
+"""
+Usage:
+  kv init
+  kv has <key>
+  kv get <key>
+  kv set <key> <val>
+  kv del <key>
+  kv keys [<prefix>]
+  kv values
+  kv scan [<prefix>]
+  kv del-prefix <prefix>
+  kv is_valid_key <key_candidate>
+  kv compact
+  kv batch [-0] [--commit-every <n>]
+  kv (help | -h | --help)
+
+The store is $KV_FILE (default .kv), a log of key=value lines where the
+last line of a key wins, and a line with only the key deletes it. The
+index $KV_FILE.idx maps every key to its last line, so that reading or
+setting a key does not depend on the size of the store. The log is
+rewritten with one line per key once it is mostly old values.
+
+kv reads stores written by kv.sh, but not the other way around: kv.sh
+takes the first line of a key rather than the last, and does not know
+escaped values or deletion lines, so it must not be used on a store
+written by kv. kv tells the two apart by the "#kv escaped" line it
+starts its stores with, and rewrites a store of kv.sh that way when it
+first changes it.
+
+keys and values list all keys or values in the order the keys were first
+set. keys with a prefix lists the keys starting with it, and scan the
+key=value lines (escaped as in the store) of them, both sorted by key.
+del-prefix deletes them. These take time in the number of keys matched,
+not in the size of the store, so eg. one directory of a store keyed by
+path can be listed or invalidated cheaply.
+
+batch runs the get, has, set and del commands read from stdin in a single
+process, one per line:
+
+  get <key>
+  has <key>
+  set <key> <val>
+  del <key>
+
+and writes the answer to each get (the value, empty if there is none) and
+has (1 or 0) to stdout in order, one per line, as soon as it is known. As
+in the store, newlines in values are written \\n and backslashes \\\\. Changes
+are committed to the index (and fsynced with KV_FSYNC=always) in groups.
+
+Options:
+  -0, --null            Commands, their arguments and answers are terminated
+                        by NUL instead, and values are not escaped. Use it
+                        for keys or values with spaces or newlines.
+  --commit-every <n>    Commit every n changes, 0 for only at the end [default: 1000]
+
+Environment:
+  KV_FILE     The store [default: .kv]
+  KEY_CHARS   Characters allowed in keys by is_valid_key [default: [A-Za-z0-9_/]]
+  KV_FSYNC    always: fsync every change before returning, never: leave
+              it to the OS, like kv.sh [default: never]
+"""
+
+from docopt import docopt
+from itertools import islice
+import fcntl
+import os
+import re
+import sqlite3
+import sys
+
+DEFAULT_KEY_CHARS = '[A-Za-z0-9_/]'
+FSYNC_POLICIES = ('always', 'never')
+# Compact when the log has this many more lines than twice the keys
+COMPACT_SLACK = 1000
+# Number of arguments of the batch commands
+BATCH_ARITY = {'get': 1, 'has': 1, 'set': 2, 'del': 1}
+# The first line of a log written by kv, whose values are escaped. The
+# values of a log without it (written by kv.sh) are read as they are
+ESCAPED_MARKER = b'#kv escaped'
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n')
+
+def unescape(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+def parse_record(line, escaped=True):
+    """(key, value) of a log line, value is None for a deletion"""
+    line = line.decode('utf-8', 'surrogateescape')
+    if '=' not in line:
+        return line, None
+    key, value = line.split('=', 1)
+    return key, unescape(value) if escaped else value
+
+def format_record(key, value):
+    line = key if value is None else key + '=' + escape(value)
+    return line.encode('utf-8', 'surrogateescape')
+
+class KV:
+    """
+    An append-only log of key=value lines with an sqlite index of key ->
+    (first set order, offset, length) of its last line. The index is only
+    a cache of the log: lines appended by others (eg. kv.sh) are indexed
+    the next time the store is opened, and it is rebuilt from scratch if
+    the log was replaced or rewritten. Every KV holds an exclusive lock on
+    the log until close().
+    Changes are written to the log at once, but only committed (to the
+    index, and the disk with fsync 'always') every commit_every changes,
+    and on commit() and close(), only then if it is 0.
+    """
+    def __init__(self, path, fsync='never', create=True, commit_every=1):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of ' + ', '.join(FSYNC_POLICIES))
+        self.path = path
+        self.fsync = fsync
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.__open_log(create)
+        self.__open_index()
+        self.__catch_up()
+
+    def __read_format(self):
+        self.escaped = os.pread(self.fd, len(ESCAPED_MARKER) + 1, 0) == ESCAPED_MARKER + b'\n'
+
+    def __open_log(self, create):
+        flags = os.O_RDWR | os.O_APPEND | (os.O_CREAT if create else 0)
+        while True:
+            self.fd = os.open(self.path, flags, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            # Another process may have compacted (replaced) the log while we waited
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.fd).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            os.close(self.fd)
+
+    def __open_index(self):
+        index_path = self.path + '.idx'
+        try:
+            self.index = self.__connect(index_path)
+        except sqlite3.DatabaseError:
+            # The index is only a cache, start over
+            os.remove(index_path)
+            self.index = self.__connect(index_path)
+
+    def __connect(self, index_path):
+        index = sqlite3.connect(index_path)
+        # Nothing is lost if the index is, it is rebuilt from the log
+        index.execute('PRAGMA synchronous = OFF')
+        index.executescript('''
+            CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, seq INTEGER, offset INTEGER, length INTEGER);
+            CREATE INDEX IF NOT EXISTS keys_seq ON keys (seq);
+            CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0),
+                inode INTEGER, size INTEGER, mtime INTEGER, records INTEGER, live INTEGER, next_seq INTEGER);
+            INSERT OR IGNORE INTO meta VALUES (0, 0, 0, 0, 0, 0, 0);
+        ''')
+        self.inode, self.size, self.mtime, self.records, self.live, self.next_seq = index.execute(
+            'SELECT inode, size, mtime, records, live, next_seq FROM meta').fetchone()
+        return index
+
+    def __save_meta(self):
+        st = os.fstat(self.fd)
+        self.inode, self.mtime = st.st_ino, st.st_mtime_ns
+        self.index.execute('UPDATE meta SET inode = ?, size = ?, mtime = ?, records = ?, live = ?, next_seq = ?',
+                           (self.inode, self.size, self.mtime, self.records, self.live, self.next_seq))
+        self.index.commit()
+
+    def __catch_up(self):
+        """Indexes the lines appended to the log since the index was last saved"""
+        self.__read_format()
+        st = os.fstat(self.fd)
+        if (st.st_ino, st.st_size, st.st_mtime_ns) == (self.inode, self.size, self.mtime):
+            return
+        if st.st_ino != self.inode or st.st_size < self.size or st.st_size == self.size:
+            # Not just appended to, index all of it again
+            self.index.execute('DELETE FROM keys')
+            self.size = self.records = self.live = self.next_seq = 0
+
+        offset = self.size
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                length = len(line.rstrip(b'\n'))
+                if offset == 0 and self.escaped:
+                    pass # the marker
+                elif length or line != b'\n':
+                    self.__index_record(*parse_record(line[:length], self.escaped), offset, length)
+                offset += len(line)
+        self.size = offset
+        self.__save_meta()
+
+    def __index_record(self, key, value, offset, length):
+        self.records += 1
+        row = self.index.execute('SELECT seq FROM keys WHERE key = ?', (key,)).fetchone()
+        if value is None:
+            if row:
+                self.index.execute('DELETE FROM keys WHERE key = ?', (key,))
+                self.live -= 1
+        elif row:
+            self.index.execute('UPDATE keys SET offset = ?, length = ? WHERE key = ?', (offset, length, key))
+        else:
+            self.index.execute('INSERT INTO keys VALUES (?, ?, ?, ?)', (key, self.next_seq, offset, length))
+            self.next_seq += 1
+            self.live += 1
+
+    def __append(self, key, value):
+        if '=' in key or '\n' in key or not key:
+            raise ValueError('Invalid key: {!r}'.format(key))
+        if not self.escaped:
+            if self.size:
+                # Written by kv.sh, escape its values before adding to it
+                self.compact()
+            else:
+                os.write(self.fd, ESCAPED_MARKER + b'\n')
+                self.size = len(ESCAPED_MARKER) + 1
+                self.escaped = True
+        record = format_record(key, value)
+        prefix = b''
+        if self.size and os.pread(self.fd, 1, self.size - 1) != b'\n':
+            # The last line (eg. written by hand) has no newline yet
+            prefix = b'\n'
+        os.write(self.fd, prefix + record + b'\n')
+        offset = self.size + len(prefix)
+        self.size = offset + len(record) + 1
+        self.__index_record(key, value, offset, len(record))
+        self.uncommitted += 1
+        if self.records > 2 * self.live + COMPACT_SLACK:
+            self.compact()
+        elif self.commit_every and self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if not self.uncommitted:
+            return
+        if self.fsync == 'always':
+            os.fdatasync(self.fd)
+        self.__save_meta()
+        self.uncommitted = 0
+
+    def __read(self, offset, length):
+        return parse_record(os.pread(self.fd, length, offset), self.escaped)[1]
+
+    def has(self, key):
+        return self.index.execute('SELECT 1 FROM keys WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key, default=None):
+        row = self.index.execute('SELECT offset, length FROM keys WHERE key = ?', (key,)).fetchone()
+        return self.__read(*row) if row else default
+
+    def set(self, key, value):
+        self.__append(key, value)
+
+    def delete(self, key):
+        """Returns False if there was no such key"""
+        if not self.has(key):
+            return False
+        self.__append(key, None)
+        return True
+
+    def __select(self, columns, prefix):
+        """Rows of the keys starting with prefix sorted by key, or all of them in the order first set"""
+        if not prefix:
+            return self.index.execute('SELECT {} FROM keys ORDER BY seq'.format(columns))
+        # A range of the primary key index: prefix <= key < the first string after all starting with prefix
+        last = prefix.rstrip(chr(sys.maxunicode))
+        if not last:
+            return self.index.execute('SELECT {} FROM keys WHERE key >= ? ORDER BY key'.format(columns), (prefix,))
+        end = last[:-1] + chr(ord(last[-1]) + 1)
+        return self.index.execute('SELECT {} FROM keys WHERE key >= ? AND key < ? ORDER BY key'.format(columns),
+                                  (prefix, end))
+
+    def keys(self, prefix=''):
+        """The keys starting with prefix sorted, or all keys in the order they were first set"""
+        for (key,) in self.__select('key', prefix):
+            yield key
+
+    def items(self, prefix=''):
+        for key, offset, length in self.__select('key, offset, length', prefix):
+            yield key, self.__read(offset, length)
+
+    def delete_prefix(self, prefix):
+        """Deletes the keys starting with prefix as one commit, returning how many"""
+        keys = list(self.keys(prefix))
+        commit_every, self.commit_every = self.commit_every, 0
+        try:
+            for key in keys:
+                self.__append(key, None)
+        finally:
+            self.commit_every = commit_every
+        self.commit()
+        return len(keys)
+
+    def compact(self):
+        """
+        Rewrites the log with only the last line of every key, atomically
+        replacing it. The values of a log written by kv.sh are escaped.
+        """
+        tmp_path = self.path + '.tmp'
+        offsets = []
+        with open(tmp_path, 'wb') as f:
+            os.fchmod(f.fileno(), os.fstat(self.fd).st_mode & 0o777)
+            f.write(ESCAPED_MARKER + b'\n')
+            offset = len(ESCAPED_MARKER) + 1
+            for key, old_offset, length in self.index.execute('SELECT key, offset, length FROM keys ORDER BY seq'):
+                record = os.pread(self.fd, length, old_offset)
+                if not self.escaped:
+                    record = format_record(*parse_record(record, escaped=False))
+                f.write(record + b'\n')
+                offsets.append((offset, key, len(record)))
+                offset += len(record) + 1
+            f.flush()
+            os.fsync(f.fileno())
+        self.index.executemany('UPDATE keys SET offset = ?, length = ? WHERE key = ?',
+                               [(o, length, key) for o, key, length in offsets])
+        os.replace(tmp_path, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        # Keep holding the lock, on the new log: anyone waiting for the old
+        # one sees it was replaced and opens the new one
+        old_fd = self.fd
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        os.close(old_fd)
+        self.escaped = True
+        self.size = offset
+        self.records = self.live
+        self.__save_meta()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.index.close()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_records(f, terminator):
+    """Yields the terminator separated records of the binary stream f as they arrive"""
+    buf = b''
+    while True:
+        chunk = f.read1(64 * 1024)
+        if not chunk:
+            break
+        *records, buf = (buf + chunk).split(terminator)
+        yield from records
+    if buf:
+        yield buf
+
+def batch_commands(f, null=False):
+    """Yields (command, arguments) of the batch read from f"""
+    decode = lambda b: b.decode('utf-8', 'surrogateescape')
+    if null:
+        tokens = read_records(f, b'\0')
+        for command in map(decode, tokens):
+            if command not in BATCH_ARITY:
+                raise ValueError('Unknown command: {!r}'.format(command))
+            args = [decode(t) for t in islice(tokens, BATCH_ARITY[command])]
+            if len(args) != BATCH_ARITY[command]:
+                raise ValueError('Missing arguments to {}'.format(command))
+            yield command, args
+        return
+
+    for line in map(decode, read_records(f, b'\n')):
+        if not line.strip():
+            continue
+        command, _, rest = line.partition(' ')
+        if command not in BATCH_ARITY:
+            raise ValueError('Unknown command: {!r}'.format(command))
+        # Only the value of set may contain spaces
+        args = rest.split(' ', BATCH_ARITY[command] - 1)
+        if len(args) != BATCH_ARITY[command] or not args[0]:
+            raise ValueError('Missing arguments to {}'.format(command))
+        if command == 'set':
+            args[1] = unescape(args[1])
+        yield command, args
+
+def run_batch(kv, commands, out, null=False):
+    """Runs the commands on kv, writing the answers to the binary stream out"""
+    terminator = b'\0' if null else b'\n'
+    for command, args in commands:
+        if command == 'get':
+            value = kv.get(args[0], '')
+            answer = value if null else escape(value)
+        elif command == 'has':
+            answer = '1' if kv.has(args[0]) else '0'
+        elif command == 'set':
+            kv.set(*args)
+            continue
+        elif command == 'del':
+            kv.delete(args[0])
+            continue
+        out.write(answer.encode('utf-8', 'surrogateescape') + terminator)
+        # The writer may wait for the answer before sending more commands
+        out.flush()
+
+def is_valid_key(key, key_chars=DEFAULT_KEY_CHARS):
+    return re.fullmatch('{0}{0}*'.format(key_chars), key) is not None
+
+def main(argv):
+    args = docopt(__doc__, argv)
+    path = os.environ.get('KV_FILE') or '.kv'
+    fsync = os.environ.get('KV_FSYNC') or 'never'
+
+    if args['help']:
+        print(__doc__.strip())
+        return 0
+
+    if args['is_valid_key']:
+        if not is_valid_key(args['<key_candidate>'], os.environ.get('KEY_CHARS') or DEFAULT_KEY_CHARS):
+            return 1
+        print(args['<key_candidate>'])
+        return 0
+
+    if args['init']:
+        if os.path.isfile(path):
+            print('{} already exists, not initiating'.format(path))
+            return 1
+        KV(path, fsync).close()
+        return 0
+
+    if not (args['set'] or args['batch']) and not os.path.isfile(path):
+        print('{} does not exist, run kv init first'.format(path), file=sys.stderr)
+        return 1
+
+    try:
+        kv = KV(path, fsync, commit_every=int(args['--commit-every']) if args['batch'] else 1)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    with kv:
+        if args['batch']:
+            try:
+                run_batch(kv, batch_commands(sys.stdin.buffer, args['--null']), sys.stdout.buffer, args['--null'])
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 2
+        elif args['has']:
+            return 0 if kv.has(args['<key>']) else 1
+        elif args['get']:
+            value = kv.get(args['<key>'])
+            if value is None:
+                return 1
+            print(value)
+        elif args['set']:
+            try:
+                kv.set(args['<key>'], args['<val>'])
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 2
+        elif args['del']:
+            return 0 if kv.delete(args['<key>']) else 1
+        elif args['keys']:
+            for key in kv.keys(args['<prefix>']):
+                print(key)
+        elif args['values']:
+            for _, value in kv.items():
+                print(value)
+        elif args['scan']:
+            for key, value in kv.items(args['<prefix>']):
+                print(key + '=' + escape(value))
+        elif args['del-prefix']:
+            return 0 if kv.delete_prefix(args['<prefix>']) else 1
+        elif args['compact']:
+            kv.compact()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,48 +4,563 @@
 # Description:
 #  Runs a command at a given time in
 #  the future. Useful once in a while.
+#  Or many times, using the daemon.
 """
-Usage: ontime [options] <timestamp> <command>
+Usage:
+  ontime [options] daemon
+  ontime [options] add [<timestamp> <command>]...
+  ontime [options] list
+  ontime [options] cancel <id>...
+  ontime [options] [<timestamp> <command>]...
 
 Options:
-   --timezone <timezone>
+   --timezone <timezone>  [default: Europe/Oslo]
+   --socket <path>        Where the daemon listens for add, list and cancel
+                          [default: ~/.cache/ontime/ontime.sock]
+   --journal <path>       Where the daemon keeps the pending jobs
+                          [default: ~/.cache/ontime/jobs.journal]
+   --precision <seconds>  Where there is no timerfd (linux only), look at
+                          the clock this often while waiting, so commands
+                          run at most this late after the clock jumps or
+                          the machine resumes from suspend [default: 1]
+   -f <file>, --file <file>  Also read jobs from <file>, one
+                          "<timestamp> <command>" per line
+   -j <n>, --jobs <n>     Run at most <n> commands at the same time [default: 4]
+   --log-dir <dir>        Write the output of each command to its own file in
+                          <dir>, the daemon defaults to ~/.cache/ontime/logs
+   --metrics <path>       Append exit status, start delay and runtime of each
+                          command to <path> as json lines, the daemon defaults
+                          to ~/.cache/ontime/metrics.jsonl
+
+Given only timestamps (DD.MM.YY H:m) and commands, waits for them in
+this process and runs each command at its time, exiting with status 1
+if any of them failed. The daemon instead runs every job added
+with `ontime add`, keeping them across restarts; jobs that became due
+while it was not running are run when it starts. Both wait for the
+wall clock to reach the timestamp, rather than for however long there
+was left when they started waiting.
 """
 
-from docopt import docopt
-import arrow
+from docopt import docopt, DocoptExit
+import errno
+import heapq
+import json
+import os
+import socket
 import sys
 import time
-import subprocess
-import shlex
+from collections import deque
+from datetime import datetime
+
+# arrow, shlex and subprocess are imported where they are used,
+# so that --help and bad arguments are quick.
+
+DEFAULT_LOG_DIR = '~/.cache/ontime/logs'
+DEFAULT_METRICS_PATH = '~/.cache/ontime/metrics.jsonl'
+
+def parse_timestamp(timestamp, timezone):
+    import arrow
+    return arrow.get(timestamp, 'DD.MM.YY H:m').replace(tzinfo=timezone)
+
+def format_time(at):
+    return datetime.fromtimestamp(at).strftime('%d.%m.%y %H:%M:%S')
+
+# From <sys/timerfd.h> and <time.h>
+CLOCK_REALTIME = 0
+TFD_NONBLOCK = 0o4000
+TFD_CLOEXEC = 0o2000000
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+
+def timerfd_functions():
+    """(create(), settime(fd, flags, deadline)) for a timerfd, or None if unavailable"""
+    if hasattr(os, 'timerfd_create'):
+        # Python 3.13+
+        return (lambda: os.timerfd_create(CLOCK_REALTIME, flags=TFD_NONBLOCK | TFD_CLOEXEC),
+                lambda fd, flags, deadline: os.timerfd_settime(fd, flags=flags, initial=deadline))
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.timerfd_create, libc.timerfd_settime
+    except (OSError, AttributeError):
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    class itimerspec(ctypes.Structure):
+        _fields_ = [('it_interval', timespec), ('it_value', timespec)]
+
+    def check(result):
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def create():
+        return check(libc.timerfd_create(CLOCK_REALTIME, TFD_NONBLOCK | TFD_CLOEXEC))
+
+    def settime(fd, flags, deadline):
+        sec, frac = divmod(deadline, 1)
+        spec = itimerspec(timespec(0, 0), timespec(int(sec), int(frac * 1e9)))
+        check(libc.timerfd_settime(fd, flags, ctypes.byref(spec), None))
+
+    return create, settime
+
+class DeadlineTimer:
+    """
+    Waits for an absolute wall clock deadline (seconds since the epoch).
+    On linux this is a timerfd on CLOCK_REALTIME, which the kernel fires
+    when the clock reaches the deadline, however much it jumps or how
+    long the machine was suspended. Elsewhere the clock is looked at
+    again at least every precision seconds, so the timer fires at most
+    that late after a jump or resume.
+    """
+    def __init__(self, precision=1, use_timerfd=True):
+        self.precision = precision
+        self.deadline = None
+        self.fd = None
+        functions = timerfd_functions() if use_timerfd else None
+        if functions:
+            create, self.__settime = functions
+            self.fd = create()
+
+    def fileno(self):
+        """The fd that becomes readable at the deadline, None without a timerfd"""
+        return self.fd
+
+    def arm(self, deadline):
+        """Sets the deadline, None to disarm"""
+        if deadline == self.deadline:
+            return
+        self.deadline = deadline
+        if self.fd is not None:
+            # A zero deadline disarms the timerfd
+            self.__settime(self.fd, TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET, deadline or 0)
+
+    def timeout(self):
+        """How long to wait before looking at the clock again, None for as long as it takes"""
+        if self.deadline is None or self.fd is not None:
+            return None
+        return min(max(0, self.deadline - time.time()), self.precision)
+
+    def clear(self):
+        """Call when fileno() is readable, returns True if the clock was changed meanwhile"""
+        try:
+            os.read(self.fd, 8)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno != errno.ECANCELED:
+                raise
+            # The clock was set, the timerfd has to be armed again
+            deadline, self.deadline = self.deadline, None
+            self.arm(deadline)
+            return True
+        return False
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def wait(self, deadline):
+        """Blocks until deadline"""
+        import select
+        self.arm(deadline)
+        while not self.expired():
+            if self.fd is not None:
+                select.select([self.fd], [], [])
+                if self.clear():
+                    print(format_time(time.time()), 'The clock was changed', file=sys.stderr)
+            else:
+                time.sleep(self.timeout())
+
+class JobStore:
+    """
+    The pending jobs, persisted as an append-only journal of json lines
+    (add, cancel and run records) so that every change is one small write.
+    The journal is rewritten with only the pending jobs once most of its
+    records are about jobs that are gone, after a meta record keeping the
+    next id, so that ids are never used twice.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {} # id -> {'id', 'at', 'command', 'cwd'}
+        self.next_id = 1
+        self.n_records = 0
+        self.file = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash while it was written
+                        continue
+                    self.__apply(record)
+        except FileNotFoundError:
+            pass
+        self.compact()
+
+    def __apply(self, record):
+        self.n_records += 1
+        if record['op'] == 'add':
+            job = record['job']
+            self.jobs[job['id']] = job
+            self.next_id = max(self.next_id, job['id'] + 1)
+        elif record['op'] == 'meta':
+            self.next_id = max(self.next_id, record['next_id'])
+        else:
+            self.jobs.pop(record['id'], None)
+
+    def __append(self, record):
+        self.__apply(record)
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def add(self, at, command, cwd=None):
+        job = {'id': self.next_id, 'at': at, 'command': command, 'cwd': cwd}
+        self.__append({'op': 'add', 'job': job})
+        return job
+
+    def remove(self, job_id, op):
+        """Removes the job with job_id, op is why: 'cancel' or 'run'"""
+        if job_id not in self.jobs:
+            return None
+        job = self.jobs[job_id]
+        self.__append({'op': op, 'id': job_id})
+        if self.n_records > 2 * len(self.jobs) + 100:
+            self.compact()
+        return job
 
-def run_command(command):
-    cmd_split = shlex.split(command)
+    def compact(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        if self.file:
+            self.file.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'op': 'meta', 'next_id': self.next_id}, separators=(',', ':')) + '\n')
+            for job in self.jobs.values():
+                f.write(json.dumps({'op': 'add', 'job': job}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.n_records = len(self.jobs) + 1
+        self.file = open(self.path, 'a')
 
-    print('Running command', cmd_split, file=sys.stderr)
-    subprocess.call(cmd_split)
+class Runner:
+    """
+    Runs jobs when they are due, at most max_running at a time, the rest
+    wait their turn in order. jobs is the dict (id -> job) of pending
+    jobs, and take(id) removes a job from it as it is started; a job
+    removed from jobs by anyone else is cancelled. Pending jobs are kept
+    in a heap ordered by time (cancelled ones are skipped when they reach
+    the top), and run() sleeps in select() until the timer of the first
+    job fires, a command exits or one of the given sockets is readable.
 
+    The output of every job goes straight to its own log file in log_dir,
+    named log_name with the job's id filled in, or to the terminal without
+    one. When a job exits, its exit status,
+    start delay and runtime are written to stderr and, as a json line, to
+    metrics_path.
+    """
+    def __init__(self, jobs, take, max_running=4, precision=1, log_dir=None, metrics_path=None,
+                 log_name='job-{id}.log'):
+        self.jobs = jobs
+        self.take = take
+        self.max_running = max_running
+        self.log_dir = log_dir
+        self.log_name = log_name
+        self.metrics_path = metrics_path
+        self.queue = [(job['at'], job['id']) for job in jobs.values()]
+        heapq.heapify(self.queue)
+        self.due = deque() # ids of due jobs waiting for a free slot
+        self.running = {} # pid -> (Popen, job, started, started_monotonic, log_path)
+        self.failed = 0
+        self.timer = DeadlineTimer(precision)
+        self.stopping = False
+
+    def add(self, job):
+        heapq.heappush(self.queue, (job['at'], job['id']))
+
+    def idle(self):
+        return not self.jobs and not self.running
+
+    def timeout(self):
+        """Arms the timer for the first pending job, returns how long select() may sleep"""
+        while self.queue and self.queue[0][1] not in self.jobs:
+            heapq.heappop(self.queue)
+        self.timer.arm(self.queue[0][0] if self.queue else None)
+        return self.timer.timeout()
+
+    def start(self, job):
+        import shlex, subprocess
+        now, now_monotonic = time.time(), time.monotonic()
+        log_path = None
+        log = None
+        if self.log_dir:
+            os.makedirs(self.log_dir, mode=0o700, exist_ok=True)
+            log_path = os.path.join(self.log_dir, self.log_name.format(id=job['id']))
+            log = open(log_path, 'ab')
+        print(format_time(now), 'Running job', job['id'], job['command'], file=sys.stderr)
+        try:
+            # The command writes to the log file itself, nothing passes through here
+            p = subprocess.Popen(shlex.split(job['command']), cwd=job.get('cwd'), stdin=subprocess.DEVNULL,
+                                 stdout=log, stderr=subprocess.STDOUT if log else None)
+        except (OSError, ValueError) as e:
+            print(format_time(now), 'Failed to run job', job['id'], e, file=sys.stderr)
+            self.finished(job, now, 0, None, log_path)
+            return
+        finally:
+            if log:
+                log.close()
+        self.running[p.pid] = (p, job, now, now_monotonic, log_path)
+
+    def finished(self, job, started, runtime, status, log_path):
+        metrics = {
+            'id': job['id'],
+            'command': job['command'],
+            'at': job['at'],
+            'started': started,
+            'start_delay': round(started - job['at'], 6),
+            'runtime': round(runtime, 6),
+            'status': status,
+            'log': log_path,
+        }
+        if status != 0:
+            self.failed += 1
+        print(format_time(time.time()), 'Job {} exited with {} after {:.3f} s, started {:.1f} ms late'.format(
+            job['id'], status, runtime, metrics['start_delay'] * 1000), file=sys.stderr)
+        if self.metrics_path:
+            os.makedirs(os.path.dirname(self.metrics_path), exist_ok=True)
+            with open(self.metrics_path, 'a') as f:
+                f.write(json.dumps(metrics, separators=(',', ':')) + '\n')
+
+    def reap(self):
+        for pid, (p, job, started, started_monotonic, log_path) in list(self.running.items()):
+            if p.poll() is not None:
+                del self.running[pid]
+                self.finished(job, started, time.monotonic() - started_monotonic, p.returncode, log_path)
+
+    def run_due(self):
+        self.reap()
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            self.due.append(heapq.heappop(self.queue)[1])
+        while self.due and len(self.running) < self.max_running:
+            job_id = self.due.popleft()
+            # Removed first, so that a crash can never run it twice
+            job = self.take(job_id)
+            if job:
+                self.start(job)
+
+    def run(self, handlers={}, until_idle=False):
+        """
+        Runs jobs until SIGTERM or SIGINT, or until there is nothing left
+        to do with until_idle. handlers is {socket: fn()}, fn is called
+        when its socket is readable.
+        """
+        import selectors, signal
+        selector = selectors.DefaultSelector()
+        for sock in handlers:
+            selector.register(sock, selectors.EVENT_READ)
+
+        # Signals only set a flag, waking up select() through this pipe, so
+        # the loop is never interrupted half way through eg. a request.
+        # SIGCHLD wakes it up when a command exits.
+        wakeup, wakeup_w = socket.socketpair()
+        wakeup_w.setblocking(False)
+        signal.set_wakeup_fd(wakeup_w.fileno())
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGCHLD, lambda *_: None)
+        selector.register(wakeup, selectors.EVENT_READ)
+        if self.timer.fileno() is not None:
+            selector.register(self.timer, selectors.EVENT_READ)
+
+        try:
+            self.run_due()
+            while not self.stopping and not (until_idle and self.idle()):
+                for key, _ in selector.select(self.timeout()):
+                    if key.fileobj is wakeup:
+                        wakeup.recv(512)
+                    elif key.fileobj is self.timer:
+                        if self.timer.clear():
+                            print(format_time(time.time()), 'The clock was changed', file=sys.stderr)
+                    else:
+                        handlers[key.fileobj]()
+                self.run_due()
+        finally:
+            signal.set_wakeup_fd(-1)
+            selector.close()
+            wakeup.close()
+            wakeup_w.close()
+        if self.running:
+            print('Left', len(self.running), 'jobs running', file=sys.stderr)
+
+class Daemon:
+    """
+    Runs the jobs of a JobStore with a Runner, taking requests to add,
+    list and cancel jobs on a unix socket.
+    """
+    def __init__(self, store, socket_path, **runner_options):
+        self.store = store
+        self.socket_path = socket_path
+        self.runner = Runner(store.jobs, lambda job_id: store.remove(job_id, 'run'), **runner_options)
+
+    def listen(self):
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            try:
+                socket.socket(socket.AF_UNIX).connect(self.socket_path)
+            except ConnectionRefusedError:
+                # Left behind by a daemon that is gone
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError('Already running, listening on ' + self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen()
+
+    def handle(self, request):
+        if request['cmd'] == 'add':
+            job = self.store.add(request['at'], request['command'], request.get('cwd'))
+            self.runner.add(job)
+            return {'ok': True, 'job': job}
+        elif request['cmd'] == 'list':
+            return {'ok': True, 'jobs': sorted(self.store.jobs.values(), key=lambda job: job['at'])}
+        elif request['cmd'] == 'cancel':
+            job = self.store.remove(request['id'], 'cancel')
+            return {'ok': job is not None, 'job': job}
+        return {'ok': False, 'error': 'No such command: ' + str(request['cmd'])}
+
+    def serve_client(self):
+        try:
+            conn, _ = self.server.accept()
+        except OSError:
+            return
+        # Only used for small local requests, do not let one hang the daemon
+        conn.settimeout(5)
+        with conn, conn.makefile('rw') as f:
+            try:
+                response = self.handle(json.loads(f.readline()))
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'ok': False, 'error': 'Bad request: {}'.format(e)}
+            except OSError:
+                return
+            try:
+                f.write(json.dumps(response) + '\n')
+                f.flush()
+            except OSError:
+                pass
+
+    def serve(self):
+        self.listen()
+        print('Listening on', self.socket_path, 'with', len(self.store.jobs), 'pending jobs', file=sys.stderr)
+        try:
+            self.runner.run({self.server: self.serve_client})
+        finally:
+            self.server.close()
+            os.remove(self.socket_path)
+
+def request(socket_path, request):
+    client = socket.socket(socket.AF_UNIX)
+    try:
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print('The daemon is not running (no one listening on {})'.format(socket_path), file=sys.stderr)
+        sys.exit(2)
+    with client, client.makefile('rw') as f:
+        f.write(json.dumps(request) + '\n')
+        f.flush()
+        return json.loads(f.readline())
+
+def print_job(job):
+    print('{:>6}  {}  {}'.format(job['id'], format_time(job['at']), job['command']))
+
+def read_jobs_file(path):
+    """[(timestamp, command)] of the "DD.MM.YY H:m command" lines in path"""
+    jobs = []
+    with open(path) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                date, hour, command = line.split(None, 2)
+                jobs.append((date + ' ' + hour, command.strip()))
+    return jobs
 
 def main():
     args = docopt(__doc__)
-    print(args)
+    socket_path = os.path.expanduser(args['--socket'])
+    timezone = args['--timezone']
+    runner_options = {
+        'max_running': int(args['--jobs']),
+        'precision': float(args['--precision']),
+        'log_dir': args['--log-dir'],
+        'metrics_path': args['--metrics'],
+    }
+
+    if args['daemon']:
+        runner_options['log_dir'] = runner_options['log_dir'] or DEFAULT_LOG_DIR
+        runner_options['metrics_path'] = runner_options['metrics_path'] or DEFAULT_METRICS_PATH
+    for option in ('log_dir', 'metrics_path'):
+        if runner_options[option]:
+            runner_options[option] = os.path.abspath(os.path.expanduser(runner_options[option]))
 
-    timezone = args.get('<timezone>',  'Europe/Oslo')
-    timestamp = arrow.get(args['<timestamp>'], 'DD.MM.YY H:m').replace(tzinfo=timezone)
-    command = args['<command>']
+    if args['daemon']:
+        Daemon(JobStore(os.path.expanduser(args['--journal'])), socket_path, **runner_options).serve()
+        return
+
+    if args['list']:
+        for job in request(socket_path, {'cmd': 'list'})['jobs']:
+            print_job(job)
+        return
+
+    if args['cancel']:
+        missing = False
+        for job_id in args['<id>']:
+            response = request(socket_path, {'cmd': 'cancel', 'id': int(job_id)})
+            if response['ok']:
+                print_job(response['job'])
+            else:
+                print('No such job:', job_id, file=sys.stderr)
+                missing = True
+        sys.exit(1 if missing else 0)
+
+    import arrow
+    timestamps = list(zip(args['<timestamp>'], args['<command>']))
+    if args['--file']:
+        timestamps += read_jobs_file(args['--file'])
+    if not timestamps:
+        raise DocoptExit()
+    jobs = [(parse_timestamp(timestamp, timezone), command) for timestamp, command in timestamps]
+
+    if args['add']:
+        for timestamp, command in jobs:
+            response = request(socket_path, {'cmd': 'add', 'at': timestamp.timestamp(), 'command': command, 'cwd': os.getcwd()})
+            print_job(response['job'])
+        return
 
     print('Timezone:', timezone)
-    print('Timestamp:', timestamp)
     now = arrow.now(timezone)
     print('Now', now)
-    
-    if now > timestamp:
-        print('Time set in the past, QUITTING!')
-        sys.exit(1)
-    
-    print('Sleeping for', timestamp - now)
-    time.sleep((timestamp - now).seconds)
+    for timestamp, command in jobs:
+        print('Timestamp:', timestamp, command)
+        if now > timestamp:
+            print('Time set in the past, QUITTING!')
+            sys.exit(1)
 
-    run_command(command)
+    pending = {i: {'id': i, 'at': timestamp.timestamp(), 'command': command}
+               for i, (timestamp, command) in enumerate(jobs, 1)}
+    print('Sleeping for', min(timestamp for timestamp, _ in jobs) - now)
+    # The ids start at 1 in every run, the log files of each run need their own names
+    log_name = 'run-{}-{}-job-{{id}}.log'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    runner = Runner(pending, pending.pop, log_name=log_name, **runner_options)
+    runner.run(until_idle=True)
+    if runner.failed or runner.stopping:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
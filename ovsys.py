@@ -16,23 +16,54 @@ Options:
   --email-host <email-host>
   --email-port <email-port>
   --email-subject-format <email-subject-format>
+  -j <n>, --jobs <n>                 Fetch up to <n> courses concurrently [default: 8]
+  --session-cache <path>             Where to cache the logged in session [default: ~/.cache/ovsys/session.json]
+  --session-ttl <seconds>            Log in again when the cached session is older than this [default: 43200]
+  --no-session-cache                 Always log in, do not read or write the session cache
+  --snapshot <path>                  Where the daemon keeps the last seen state [default: ~/.cache/ovsys/snapshots.json]
+  --min-interval <seconds>           Poll interval of recently changed courses [default: 60]
+  --max-interval <seconds>           Poll interval quiet courses back off to [default: 1800]
+  --digest-window <seconds>          Collect changes for this long into a single email [default: 60]
+  --base-url <url>                   Talk to another ovsys instance, eg. a local replay server
+                                     (defaults to $OVSYS_BASE_URL or https://ovsys.math.ntnu.no)
+  --offline                          Only use pages from the http cache, do not log in or fetch anything
+  --no-http-cache                    Do not read or write the shared http cache
+  --rate <requests-per-second>       Limit the daemon to this many requests to ovsys per second [default: 5]
+  --profile                          Time session init, login, fetching, parsing and rendering,
+                                     writing a json report to stderr on exit
+  --profile-file <path>              Write the --profile report to <path> instead
+  --cprofile <path>                  Also write cProfile stats of the main thread to <path>
 
 Commands:
    ls|list [-a] <courses>            Displays a list of all courses
    daemon <courses>                  Sends an email when one of the courses changes
+
+The daemon watches every account listed under "accounts" in the config,
+each entry like {"username": ..., "password": ..., "courses": [<patterns>],
+"email": {<overrides of the email section, eg. recipient>}}, or only the
+"ovsys" account when there is no such list.
 """
 
 # Author: Jørgen Bele Reinfjell
 # Description: Command-line utility to ease use of the ovsys2
 # Date: 26.01.2019 [dd.mm.yyyy]
 
-from bs4 import BeautifulSoup as BS
 from docopt import docopt
-import json, re, requests, sys, os
+import httpcache
+from profiling import profiler
+import json, re, sys, os, threading, time, heapq, random
 from collections import defaultdict
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain, islice
+
+# Slow to import modules (bs4, lxml, requests, asyncio, smtplib,
+# concurrent.futures) are imported where they are used, so that
+# --help, ls of cached pages and bad commands start quickly.
 
-OVSYS_BASE_URL = 'https://ovsys.math.ntnu.no'
+OVSYS_BASE_URL = os.environ.get('OVSYS_BASE_URL', 'https://ovsys.math.ntnu.no')
+DEFAULT_JOBS = 8
+DEFAULT_SESSION_TTL = 12 * 60 * 60 # seconds
 
 class ovsys:
     headers = {
@@ -52,12 +83,36 @@ class ovsys:
     session = None
     csrfmiddlewaretoken = None
 
-    def __init__(self):
-        pass
+    # Set by restore_or_login, used to log in again when the session expires
+    credentials = None
+    session_cache_path = None
+    session_ttl = DEFAULT_SESSION_TTL
+    pool_size = DEFAULT_JOBS
+
+    # Pages are fetched through this httpcache.HTTPCache,
+    # skipping the parsing of pages that did not change
+    http_cache = httpcache.HTTPCache(None)
+
+    def __init__(self, adapter=None):
+        """adapter is a requests HTTPAdapter to share with other instances"""
+        self.adapter = adapter
+        self.__login_lock = threading.Lock()
+        self.__login_generation = 0
 
-    def initialize_session(self):
+    def __new_session(self, pool_size):
+        import requests
         self.session = requests.session()
-        r = self.session.get(OVSYS_BASE_URL, headers=self.headers)
+        # Keep enough pooled connections around for concurrent fetching,
+        # so every worker reuses an already established TLS connection.
+        adapter = self.adapter or requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def initialize_session(self, pool_size=DEFAULT_JOBS):
+        with profiler.phase('session-init', url=OVSYS_BASE_URL) as phase:
+            self.__new_session(pool_size)
+            r = self.session.get(OVSYS_BASE_URL, headers=self.headers)
+            phase['bytes'] = len(r.content)
         str_find = 'csrfmiddlewaretoken: \''
         mwtoken_start = r.text.find(str_find) + len(str_find)
         mwtoken_end = r.text.find('\'', mwtoken_start)
@@ -75,13 +130,112 @@ class ovsys:
             'password': password,
             'next': next_url
         }
-        r = self.session.post(OVSYS_BASE_URL + '/login/', data=data, headers=self.headers)
+        with profiler.phase('login', url=OVSYS_BASE_URL + '/login/') as phase:
+            r = self.session.post(OVSYS_BASE_URL + '/login/', data=data, headers=self.headers)
+            phase['bytes'] = len(r.content)
 
         self.cached_frontpage_html = r.text
         return r
 
-    def __get(self, url_suffix=''):
-        r = self.session.get(OVSYS_BASE_URL + url_suffix, headers=self.headers)
+    def restore_or_login(self, username, password, cache_path=None, ttl=DEFAULT_SESSION_TTL, pool_size=DEFAULT_JOBS):
+        """
+        Restores the session cached at cache_path if it belongs to username
+        and has not expired, otherwise does a full login and caches the new
+        session. Sessions found to be expired later on are renewed the same way.
+        """
+        self.credentials = (username, password)
+        self.session_cache_path = cache_path
+        self.session_ttl = ttl
+        self.pool_size = pool_size
+
+        with profiler.phase('session-restore', path=cache_path) as phase:
+            phase['restored'] = bool(cache_path and self.load_session(cache_path, username))
+        if phase['restored']:
+            return True
+        return self.__full_login()
+
+    def __full_login(self):
+        username, password = self.credentials
+        if not self.initialize_session(self.pool_size):
+            return False
+        r = self.login(username, password)
+        if not r or self.__is_login_page(r):
+            return False
+        if self.session_cache_path:
+            self.save_session(self.session_cache_path, username, self.session_ttl)
+        return True
+
+    def save_session(self, path, username, ttl=DEFAULT_SESSION_TTL):
+        """Writes the cookies, csrf token and frontpage to path (mode 0600)."""
+        data = {
+            'username': username,
+            'base_url': OVSYS_BASE_URL,
+            'expires': time.time() + ttl,
+            'csrfmiddlewaretoken': self.csrfmiddlewaretoken,
+            'frontpage_html': self.cached_frontpage_html,
+            'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+                         'expires': c.expires, 'secure': c.secure} for c in self.session.cookies],
+        }
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+        return True
+
+    def load_session(self, path, username):
+        """Restores a session written by save_session, returns False if it is unusable."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        now = time.time()
+        if data.get('username') != username or data.get('base_url') != OVSYS_BASE_URL:
+            return False
+        if data.get('expires', 0) <= now:
+            return False
+        if any(c['expires'] is not None and c['expires'] <= now for c in data['cookies']):
+            return False
+
+        self.__new_session(self.pool_size)
+        for c in data['cookies']:
+            self.session.cookies.set(c['name'], c['value'], domain=c['domain'], path=c['path'],
+                                     expires=c['expires'], secure=c['secure'])
+        self.csrfmiddlewaretoken = data['csrfmiddlewaretoken']
+        self.cached_frontpage_html = data['frontpage_html']
+        return True
+
+    @staticmethod
+    def __is_login_page(r):
+        return '/login' in r.url or 'name="password"' in r.text
+
+    def __relogin(self, generation):
+        with self.__login_lock:
+            if generation != self.__login_generation:
+                # Another thread already logged in again
+                return
+            assert self.__full_login()
+            self.__login_generation += 1
+
+    def __fetch(self, url_suffix, parse=None):
+        return self.http_cache.fetch(OVSYS_BASE_URL + url_suffix, session=self.session, headers=self.headers,
+                                     parse=parse, namespace=self.credentials[0] if self.credentials else '',
+                                     cacheable=lambda r: not self.__is_login_page(r))
+
+    def __get(self, url_suffix='', parse=None):
+        generation = self.__login_generation
+        r = self.__fetch(url_suffix, parse)
+        if self.credentials and self.__is_login_page(r):
+            # The (possibly restored) session has expired
+            self.__relogin(generation)
+            r = self.__fetch(url_suffix, parse)
+        if not r.ok:
+            # An error page would parse as a course without exercises
+            r.raise_for_status()
         return r
 
     def __update_cached_frontpage(self):
@@ -90,9 +244,26 @@ class ovsys:
     def get_classes_urls(self):
         if not self.cached_frontpage_html:
             self.__update_cached_frontpage()
-        bs = BS(self.cached_frontpage_html, features='lxml')
-        classes_links = [link.get('href') for link in bs.findAll('a') if re.search('^/student/', link.get('href'))]
-        return classes_links
+        with profiler.phase('parse', url=OVSYS_BASE_URL + '/'):
+            return self.parse_classes_urls(self.cached_frontpage_html)
+
+    # Which extraction path the parse_* methods use: 'lxml' or 'bs4'.
+    # Both return identical results, 'bs4' is kept as the reference.
+    parser = 'lxml'
+
+    # Selectors for the lxml extraction path, see xpath
+    __xpath_classes_urls = "//a[starts-with(@href, '/student/')]/@href"
+    __xpath_exercises = "//a[contains(@href, '/exercise/')]"
+    __xpath_exercise_name = "(.//div[@class='col-xs-12 col-sm-6 col-md-8'])[1]//strong"
+    __xpath_exercise_status = "(.//div[@class='col-xs-12 col-sm-6 col-md-4'])[1]"
+
+    def parse_classes_urls(self, html, parser=None):
+        if (parser or self.parser) == 'bs4':
+            from bs4 import BeautifulSoup as BS
+            bs = BS(html, features='lxml')
+            return [link.get('href') for link in bs.findAll('a') if re.search('^/student/', link.get('href'))]
+        from lxml import html as lxml_html
+        return [str(href) for href in xpath(self.__xpath_classes_urls)(lxml_html.fromstring(html))]
 
     __status_states_list = ['delivered', 'corrected', 'graded']
     status_states = {
@@ -114,8 +285,27 @@ class ovsys:
         return states
 
     def get_class_exercises(self, class_url):
-        r = self.__get(class_url)
-        bs = BS(r.text, features='lxml')
+        return self.__get(class_url, parse=self.parse_class_exercises).parsed
+
+    def parse_class_exercises(self, html, parser=None):
+        if (parser or self.parser) == 'bs4':
+            return self.__parse_class_exercises_bs4(html)
+
+        from lxml import html as lxml_html
+        xpath_name = xpath(self.__xpath_exercise_name)
+        xpath_status = xpath(self.__xpath_exercise_status)
+        ret = []
+        for elem in xpath(self.__xpath_exercises)(lxml_html.fromstring(html)):
+            ret.append({
+                'id': elem.get('href').split('/')[-1],
+                'name': xpath_name(elem)[0].text_content(),
+                'status': self.__status_str_to_table(xpath_status(elem)[0].text_content().strip()),
+            })
+        return ret
+
+    def __parse_class_exercises_bs4(self, html):
+        from bs4 import BeautifulSoup as BS
+        bs = BS(html, features='lxml')
         exercises_elems = [link for link in bs.findAll('a') if re.search('/exercise/', link.get('href'))]
         ret = []
         for elem in exercises_elems:
@@ -127,31 +317,351 @@ class ovsys:
             ret.append(elem_data)
         return ret
 
+    def get_classes_exercises(self, class_urls, jobs=1):
+        """
+        Fetches the exercises of every url in class_urls using up to
+        jobs concurrent requests. Results are yielded in the same order
+        as class_urls, as soon as they (and all before them) are ready.
+        """
+        if jobs <= 1 or len(class_urls) <= 1:
+            for url in class_urls:
+                yield self.get_class_exercises(url)
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(jobs, len(class_urls))) as executor:
+            yield from executor.map(self.get_class_exercises, class_urls)
+
+    @staticmethod
+    def set_base_url(base_url):
+        global OVSYS_BASE_URL
+        OVSYS_BASE_URL = base_url.rstrip('/')
+        ovsys.headers = dict(ovsys.headers, Referer=OVSYS_BASE_URL)
+
     @staticmethod
     def class_url_to_code(class_name):
         return class_name.split('/')[2]
 
 #
+@lru_cache(maxsize=None)
+def xpath(expression):
+    """The compiled lxml XPath of expression, compiled only once"""
+    from lxml import etree
+    return etree.XPath(expression)
+
+def describe_change(change):
+    """Describes a single change returned by SnapshotStore.update"""
+    yes_no = lambda b: ('yes' if b else 'no') if type(b) == bool else b
+    fields = ['delivered', 'corrected', 'graded']
+    if change['old'] is None:
+        return '{}: new exercise'.format(change['name'])
+    if change['new'] is None:
+        return '{}: removed'.format(change['name'])
+    diffs = ['{} {} -> {}'.format(f, yes_no(old), yes_no(new))
+             for f, old, new in zip(fields, change['old'][1:], change['new'][1:]) if old != new]
+    return '{}: {}'.format(change['name'], ', '.join(diffs))
+
 def gen_msg(config, changed):
-    s = ''
-    for e in changed:
-        s += str(e)
-    return s
+    """Builds a single email message for a list of changes in one or more courses"""
+    by_course = defaultdict(list)
+    for change in changed:
+        by_course[ovsys.class_url_to_code(change['course'])].append(change)
+
+    subject = config['email']['subject_format'].format(class_code=', '.join(by_course.keys()))
+    body = ''
+    for class_code, changes in by_course.items():
+        if len(by_course) > 1:
+            body += '{}:\n'.format(class_code)
+        body += ''.join(describe_change(c) + '\n' for c in changes)
+    from email.message import EmailMessage
+    from email.utils import formatdate, make_msgid
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = config['email']['sender']
+    msg['To'] = config['email']['recipient']
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid()
+    # Quoted-printable keeps the message 7-bit for servers without 8BITMIME
+    msg.set_content(body, cte='quoted-printable')
+    return msg
+
+# DAEMON
+class SnapshotStore:
+    """
+    Keeps the last seen state of every watched course in memory and in a
+    json file, so that a restarted daemon does not report false changes.
+    A course snapshot maps exercise id -> [name, delivered, corrected, graded].
+    """
+    fields = ['delivered', 'corrected', 'graded']
+
+    def __init__(self, path=None):
+        self.path = path
+        self.courses = {}
+        self.dirty = False
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.courses = json.load(f)
+        except FileNotFoundError:
+            self.courses = {}
+        return True
 
-# MAIL
-import smtplib
-def send_mail(config, msg):
-    email = config['email']
-    print('email:', email)
-    server = smtplib.SMTP(email['host'], email['port'])
-    server.ehlo()
-    server.starttls()
+    def save(self):
+        if not self.path or not self.dirty:
+            return False
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.courses, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        return True
+
+    @classmethod
+    def compact(cls, exercises):
+        return {e['id']: [e['name']] + [e['status'][k] if e['status'] else None for k in cls.fields]
+                for e in exercises}
+
+    def update(self, key, exercises):
+        """
+        Stores the new state of course key and returns the list of changed
+        exercises. The first snapshot of a course only sets the baseline.
+        """
+        new = self.compact(exercises)
+        old = self.courses.get(key)
+        if old and not new:
+            # Exercises are not taken down, this is a page that failed to
+            # load. Storing it would report every exercise as removed, and
+            # as new again on the next poll
+            return []
+        if old == new:
+            # The common case, a single comparison of the two dicts
+            return []
+
+        self.courses[key] = new
+        self.dirty = True
+        if old is None:
+            return []
+
+        changes = [{'course': key, 'id': i, 'name': state[0], 'old': old.get(i), 'new': state}
+                   for i, state in new.items() if old.get(i) != state]
+        changes += [{'course': key, 'id': i, 'name': old[i][0], 'old': old[i], 'new': None}
+                    for i in old.keys() - new.keys()]
+        return changes
+
+class PollScheduler:
+    """
+    Adaptive poll schedule. A course that changed is polled again after
+    min_interval, every quiet poll multiplies its interval by backoff up
+    to max_interval. A random jitter spreads out the requests.
+    """
+    def __init__(self, keys, min_interval, max_interval, backoff=1.5, jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.intervals = {key: min_interval for key in keys}
+        now = time.time()
+        self.queue = [(now, key) for key in keys]
+        heapq.heapify(self.queue)
+
+    def next_time(self):
+        return self.queue[0][0]
+
+    def due(self, now):
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            due.append(heapq.heappop(self.queue)[1])
+        return due
+
+    def reschedule(self, key, changed, now):
+        if changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals[key] * self.backoff, self.max_interval)
+        self.intervals[key] = interval
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        heapq.heappush(self.queue, (now + interval, key))
+
+class RateLimiter:
+    """Token bucket limiting how many requests are started per second"""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        import asyncio
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        import asyncio
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Daemon:
+    """
+    Watches the courses of any number of accounts from a single event loop.
+    The accounts share one connection pool, one pool of fetch threads, one
+    rate limit and one snapshot store; each account only adds its own
+    session, poll schedule and notification queue.
+    """
+    def __init__(self, store, jobs=DEFAULT_JOBS, rate=5):
+        self.store = store
+        self.rate = rate
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        # Mailers are not thread safe, all mail goes through one thread
+        self.mail_executor = ThreadPoolExecutor(max_workers=1)
+        self.accounts = []
+
+    def add_account(self, o, name, scheduler, notifications=None, on_changes=None):
+        """on_changes(name, url, changes) is called for every changed course"""
+        self.accounts.append((o, name, scheduler, notifications, on_changes))
+
+    async def watch(self, o, name, scheduler, notifications, on_changes):
+        if not scheduler.intervals:
+            return
+        import asyncio
+        loop = asyncio.get_running_loop()
+
+        async def fetch(url):
+            await self.limiter.acquire()
+            return await loop.run_in_executor(self.executor, o.get_class_exercises, url)
 
-    #Next, log in to the server
-    server.login(email['username'], email['password'])
+        while True:
+            if notifications:
+                await loop.run_in_executor(self.mail_executor, notifications.flush)
+
+            now = time.time()
+            due = scheduler.due(now)
+            if not due:
+                wake_at = scheduler.next_time()
+                if notifications and notifications.deadline:
+                    wake_at = min(wake_at, notifications.deadline)
+                await asyncio.sleep(max(0, wake_at - now))
+                continue
+
+            results = await asyncio.gather(*(fetch(url) for url in due), return_exceptions=True)
+            for url, exercises in zip(due, results):
+                if isinstance(exercises, Exception):
+                    pprint(datetime.now(), name, 'failed to fetch', url + ':', exercises, warning=True)
+                    scheduler.reschedule(url, False, now)
+                    continue
+                changes = self.store.update(name + ':' + url, exercises)
+                scheduler.reschedule(url, bool(changes), time.time())
+                if changes and on_changes:
+                    on_changes(name, url, changes)
+            self.store.save()
+
+    async def run_async(self):
+        import asyncio
+        # Created here, as it belongs to the running event loop
+        self.limiter = RateLimiter(self.rate)
+        await asyncio.gather(*(self.watch(*account) for account in self.accounts))
+
+    def run(self):
+        import asyncio
+        asyncio.run(self.run_async())
 
-    #Send the mail
-    server.sendmail(email['sender'], email['recipient'], msg)
+# MAIL
+class Mailer:
+    """
+    Delivers mail over a single persistent SMTP connection. The connection
+    is reopened when the server has dropped it, and failed deliveries are
+    retried with an exponential backoff.
+    """
+    def __init__(self, email, retries=3, retry_delay=2):
+        self.email = email
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.server = None
+
+    def connect(self):
+        import smtplib
+        self.close()
+        server = smtplib.SMTP(self.email['host'], self.email['port'])
+        server.ehlo()
+        if self.email.get('starttls', True):
+            server.starttls()
+            server.ehlo()
+
+        #Next, log in to the server
+        if self.email.get('username'):
+            server.login(self.email['username'], self.email['password'])
+        self.server = server
+
+    def close(self):
+        import smtplib
+        if self.server:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def send(self, msg, recipient=None):
+        import smtplib
+        for attempt in range(self.retries + 1):
+            try:
+                if not self.server:
+                    self.connect()
+                self.server.send_message(msg, self.email['sender'], recipient or self.email['recipient'])
+                return True
+            except (smtplib.SMTPException, OSError) as e:
+                # The connection may be unusable, start over with a new one
+                self.server = None
+                if attempt == self.retries:
+                    raise
+                pprint(datetime.now(), 'Failed to send email, retrying:', e, warning=True)
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+class NotificationQueue:
+    """
+    Collects changes and delivers everything that arrived within window
+    seconds of the first pending change as a single digest message.
+    """
+    def __init__(self, config, mailer, window):
+        self.config = config
+        self.mailer = mailer
+        self.window = window
+        self.pending = []
+        self.deadline = None
+
+    def add(self, changes):
+        if not self.pending:
+            self.deadline = time.time() + self.window
+        self.pending += changes
+
+    def flush(self, force=False):
+        if not self.pending or (not force and time.time() < self.deadline):
+            return False
+        import smtplib
+        try:
+            self.mailer.send(gen_msg(self.config, self.pending), self.config['email']['recipient'])
+        except (smtplib.SMTPException, OSError) as e:
+            # Keep the changes around for the next attempt
+            pprint(datetime.now(), 'Failed to send email:', e, warning=True)
+            self.deadline = time.time() + self.window
+            return False
+        print(datetime.now(), 'SENT EMAIL')
+        self.pending = []
+        self.deadline = None
+        return True
+
+def send_mail(config, msg):
+    mailer = Mailer(config['email'])
+    mailer.send(msg)
+    mailer.close()
     print(datetime.now(), 'SENT EMAIL')
 
 # CLI UTILITY
@@ -181,14 +691,14 @@ def load_config(path=DEFAULT_CONFIG_PATH):
         #print('loaded', config)
     return True
 
-def get_matches(ovsys, args):
+def get_matches(ovsys, patterns):
     class_urls = ovsys.get_classes_urls()
     matches = []
 
-    if len(args['<args>']) == 0:
+    if len(patterns) == 0:
         matches = class_urls
     else:
-        for arg in args['<args>']:
+        for arg in patterns:
             c_matches = [url for url in class_urls if re.search(arg, url)]
             matches += c_matches
     return matches
@@ -200,28 +710,62 @@ def main(argv):
     ArgFlags.from_args(args)
     if ArgFlags.verbose:
         print(args)
+    if ArgFlags.profile:
+        profiler.enable(args['--profile-file'], args['--cprofile'])
 
     if args['--config']:
         assert load_config(os.path.expanduser(args['--config']))
     else:
         load_config()
 
+    if args['--base-url']:
+        ovsys.set_base_url(args['--base-url'])
+
     # These flags override the config file
     # ovsys
+    config.setdefault('ovsys', {})
     for key in config['ovsys'].keys():
         if args['--' + key]:
             config['ovsys'][key] = args['--' + key]
 
     # email
     for key in config['email'].keys():
-        if args['--email-' + key.replace('_', '-')]:
-            config['email'][key] = args['--email-' + key]
-
-    assert config['ovsys']['username'] and config['ovsys']['password']
-
-    o = ovsys()
-    assert o.initialize_session()
-    assert o.login(config['ovsys']['username'], config['ovsys']['password'])
+        # Not every setting (eg. starttls) has an option
+        option = '--email-' + key.replace('_', '-')
+        if args.get(option):
+            config['email'][key] = args[option]
+
+    accounts = config.get('accounts') or [config['ovsys']]
+    for account in accounts:
+        assert account.get('username') and account.get('password')
+
+    jobs = int(args['--jobs'])
+    assert jobs > 0
+
+    session_cache_path = None
+    if not args['--no-session-cache']:
+        session_cache_path = os.path.expanduser(args['--session-cache'])
+
+    http_cache = httpcache.HTTPCache(None if args['--no-http-cache'] else httpcache.DEFAULT_CACHE_DIR,
+                                     offline=args['--offline'])
+
+    def login(account, adapter=None):
+        cache_path = session_cache_path
+        if cache_path and len(accounts) > 1:
+            root, ext = os.path.splitext(cache_path)
+            cache_path = '{}-{}{}'.format(root, account['username'], ext)
+        o = ovsys(adapter)
+        o.http_cache = http_cache
+        if args['--offline']:
+            # Only for the cached frontpage, nothing is fetched
+            o.credentials = (account['username'], account['password'])
+            if cache_path:
+                o.load_session(cache_path, account['username'])
+            return o
+        assert o.restore_or_login(account['username'], account['password'],
+                                  cache_path=cache_path, ttl=int(args['--session-ttl']),
+                                  pool_size=jobs)
+        return o
 
     headers = []
     rows = []
@@ -230,7 +774,10 @@ def main(argv):
         show_all = True
 
     if args['<command>'] in ('list', 'ls'):
-        matches = get_matches(o, args)
+        o = login(config['ovsys'] if config['ovsys'].get('username') else accounts[0])
+        matches = get_matches(o, args['<args>'])
+        if show_all:
+            exercises = o.get_classes_exercises(matches, jobs)
         for url in matches:
             class_code = ovsys.class_url_to_code(url)
             pprint(class_code + (':' if show_all else ''), bold=True)
@@ -240,7 +787,7 @@ def main(argv):
                 col_opts = ['left', 'center', 'center', 'center']
                 enabled_rows = set()
                 rows = []
-                for i, elem in enumerate(o.get_class_exercises(url)):
+                for i, elem in enumerate(next(exercises)):
                     s = elem['status']
                     yes_no = lambda b: ('yes' if b else 'no') if type(b) == bool else b
                     #yes_no = lambda b: b
@@ -249,26 +796,48 @@ def main(argv):
                     rows.append([maybe_quote(elem['name']), yes_no(s['delivered']), yes_no(s['corrected']), yes_no(s['graded'])])
                     if s['graded'] == 'pass':
                         enabled_rows.add(i)
-                print_rows(rows, spacing=3, header=headers, enabled_rows=enabled_rows, column_options=col_opts)
+                with profiler.phase('render', rows=len(rows)):
+                    print_rows(rows, spacing=3, header=headers, enabled_rows=enabled_rows, column_options=col_opts)
                 print()
 
     elif args['<command>'] == 'daemon':
-        matches = get_matches(o, args)
-        prev_state = [] # list of results of class_exercises()
-        print('Watching:', matches)
-        while True:
-            for url in matches:
-                class_code = ovsys.class_url_to_code(url)
-                pprint(class_code + (':' if show_all else ''), bold=True)
-                exercises = o.get_class_exercises(url)
-                if state != prev_state:
-                    # TODO
-                    print('CHANGED')
-                    print('STATE', state)
-                    msg = gen_msg(config, ['test1', 'test2'])
-                    send_mail(config, msg)
-                print('DID NOT CHANGE')
-            sleep(10)
+        import requests
+        from concurrent.futures import ThreadPoolExecutor
+        # One connection pool shared by the sessions of all accounts
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+        store = SnapshotStore(os.path.expanduser(args['--snapshot']))
+        daemon = Daemon(store, jobs=jobs, rate=float(args['--rate']))
+        mailer = Mailer(config['email'])
+
+        def on_changes(name, url, changes):
+            pprint(datetime.now(), name, ovsys.class_url_to_code(url), 'CHANGED', bold=True)
+            for change in changes:
+                print('   ', describe_change(change))
+            notifications[name].add(changes)
+
+        notifications = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            sessions = list(executor.map(lambda account: login(account, adapter), accounts))
+        for account, o in zip(accounts, sessions):
+            name = account['username']
+            matches = get_matches(o, account.get('courses', args['<args>']))
+            print('Watching:', name, matches)
+
+            account_config = dict(config, email=dict(config['email'], **account.get('email', {})))
+            notifications[name] = NotificationQueue(account_config, mailer, float(args['--digest-window']))
+            scheduler = PollScheduler(matches, float(args['--min-interval']), float(args['--max-interval']))
+            daemon.add_account(o, name, scheduler, notifications=notifications[name], on_changes=on_changes)
+        # A stopped daemon still mails what it has queued, see below
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            daemon.run()
+        finally:
+            # The snapshot already counts the pending changes as seen
+            daemon.mail_executor.shutdown(wait=True)
+            for queue in notifications.values():
+                queue.flush(force=True)
+            mailer.close()
 
     else:
         print('No such command: `{}`'.format(args['<command>']))
@@ -284,6 +853,7 @@ class ArgFlags:
     pretty_or_terse_flag_present = False
     verbose = False
     interactive = False
+    profile = False
 
     @staticmethod
     def from_args(args):
@@ -297,6 +867,8 @@ class ArgFlags:
                 ArgFlags.pretty_or_terse_flag_present = True
             elif arg == '--verbose':
                 ArgFlags.verbose = True
+            elif arg in ('--profile', '--profile-file', '--cprofile'):
+                ArgFlags.profile = True
 
         if not ArgFlags.pretty_or_terse_flag_present:
             # use --pretty implicitly when interactive
@@ -335,69 +907,84 @@ def pprint(fargs, *args, word_wrap=True, warning=False, bold=False, success=Fals
 def stringify(row):
     return [str(c) for c in row]
 
-def align_columns(rows, column_options=None, spacing=1, header=None):
+def align_columns(rows, column_options=None, spacing=1, header=None, widths=None, lookahead=1000):
     """
-    Aligns columns in a row of items.
+    Aligns columns in a row of items, yielding one line per row (header first).
     column_options is a list containing descibing how each column
     should be aligned
     Example: ['left', 'center', 'right'] will align the first column to the
     left, the second to the center, and the third to the right.
+    Column widths are the given widths, or else the widest cell of each
+    column among the header and the first lookahead rows. Wider rows after
+    that are not cut, only out of line, so that lines can be produced
+    while rows is still being iterated.
     """
-
-    srows = []
+    rows = iter(rows)
+    first_rows = []
     if header:
-        srows.append(stringify(header))
-    srows = srows + [stringify(row) for row in rows]
-
-    column_details = {}
-    for r in srows:
-        for i, c in enumerate(r):
-            if i not in column_details:
-                column_details[i] = {'width': 0}
-            column_details[i]['width'] = max(column_details[i]['width'], len(c))
+        first_rows.append(stringify(header))
+    if widths is None:
+        first_rows += [stringify(row) for row in islice(rows, lookahead)]
+        widths = []
+        for r in first_rows:
+            for i, c in enumerate(r):
+                if i == len(widths):
+                    widths.append(0)
+                widths[i] = max(widths[i], len(c))
 
     spacing_str = ' ' * spacing
 
-    def align_row(row):
-        nonlocal column_details, column_options
+    def row_format(n_columns):
         out_columns = []
-        for i, c in enumerate(row):
+        for i in range(n_columns):
             align_chr = '<' # left-align by default
             if column_options:
                 if column_options[i] == 'right':
                         align_chr = '>'
                 elif column_options[i] == 'center':
                         align_chr = '^'
-            out_columns.append('{0:{1}{2}}'.format(c, align_chr, column_details[i]['width']))
+            width = widths[i] if i < len(widths) else 0
+            out_columns.append('{%d:%s%d}' % (i, align_chr, width))
         return spacing_str.join(out_columns)
 
-    out = []
-    for r in srows:
-        out.append(align_row(r))
-    return out
+    # One format string per number of columns, usually just one per table
+    formats = {}
+    for r in chain(first_rows, (stringify(row) for row in rows)):
+        if len(r) not in formats:
+            formats[len(r)] = row_format(len(r))
+        yield formats[len(r)].format(*r)
 
 
-def print_rows(rows, column_options=None, spacing=1, header=None, enabled_rows=set(), **kwargs):
+def print_rows(rows, column_options=None, spacing=1, header=None, enabled_rows=set(), widths=None, **kwargs):
+    """
+    Prints rows (any iterable) while they are produced, see align_columns
+    for widths.
+    """
     # TODO **kwargs
     # Only print header if pretty
-    if len(rows) < 1:
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
         return False
-
+    rows = chain([first_row], rows)
     if ArgFlags.pretty:
-        aligned = align_columns(rows=rows, column_options=column_options, spacing=spacing, header=header)
+        aligned = align_columns(rows=rows, column_options=column_options, spacing=spacing, header=header, widths=widths)
         #print(aligned)
         if header:
-            pprint(aligned[0], arch=True, header=True, **kwargs)
-            aligned.pop(0)
+            pprint(next(aligned), arch=True, header=True, **kwargs)
         for i, row in enumerate(aligned):
             pprint(row, enabled=(i in enabled_rows), **kwargs)
     else:
         for row in rows:
-            print('{}'.format(' '.join(stringify(row))))
+            print(' '.join(stringify(row)), **kwargs)
 
     return True
 ### END OF COPY
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    try:
+        main(sys.argv[1:])
+    except httpcache.OfflineCacheMiss as e:
+        print('Not in the cache:', e, file=sys.stderr)
+        sys.exit(1)
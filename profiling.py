@@ -0,0 +1,100 @@
+# Author: Jørgen Bele Reinfjell
+# Date: 17.10.2026 [dd.mm.yyyy]
+# Description:
+#   Opt-in timing of the phases of a run (session init,
+#   login, fetch, parse, render, ...) for the --profile
+#   flag of the tools, reported as json.
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+class Profiler:
+    """
+    Records how long each phase took while enabled, phase() does nothing
+    otherwise. The report is written when the program exits.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.report_path = None
+        self.cprofile = None
+        self.cprofile_path = None
+
+    def enable(self, report_path=None, cprofile_path=None):
+        """
+        Writes the report to report_path, or stderr if None. With
+        cprofile_path, the main thread is also run under cProfile and its
+        stats written there, readable with `python -m pstats`.
+        """
+        self.enabled = True
+        self.start = time.perf_counter()
+        self.started = time.time()
+        self.report_path = report_path
+        if cprofile_path:
+            import cProfile
+            self.cprofile_path = cprofile_path
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        atexit.register(self.finish)
+
+    @contextmanager
+    def phase(self, name, **info):
+        """
+        Times the with block as the phase name. The yielded dict is
+        included in the report, so eg. byte counts can be added to it.
+        """
+        if not self.enabled:
+            yield info
+            return
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            end = time.perf_counter()
+            record = {'name': name, 'thread': threading.current_thread().name,
+                      'start': round(start - self.start, 6), 'duration': round(end - start, 6)}
+            record.update(info)
+            # list.append is atomic, phases may end in several threads at once
+            self.phases.append(record)
+
+    def report(self):
+        summary = {}
+        for p in self.phases:
+            s = summary.setdefault(p['name'], {'count': 0, 'duration': 0, 'bytes': 0})
+            s['count'] += 1
+            s['duration'] = round(s['duration'] + p['duration'], 6)
+            s['bytes'] += p.get('bytes') or 0
+        return {
+            # Not the whole command line, option values may be passwords
+            'command': os.path.basename(sys.argv[0]),
+            'flags': [arg.split('=', 1)[0] for arg in sys.argv[1:] if arg.startswith('-')],
+            'started': self.started,
+            'duration': round(time.perf_counter() - self.start, 6),
+            'summary': summary,
+            'phases': sorted(self.phases, key=lambda p: p['start']),
+        }
+
+    def finish(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+
+        report = self.report()
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            sys.stderr.flush()
+            json.dump(report, sys.stderr, indent=2)
+            print(file=sys.stderr)
+
+# The profiler of the running tool, enabled by --profile
+profiler = Profiler()